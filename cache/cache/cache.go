@@ -34,6 +34,8 @@ type (
 		cacheSignal      *int32
 		cacheTouchTime   time.Time
 		aliasesTouchTime time.Time
+		// ETag of the alias map from the last GET /aliases
+		aliasesVersion string
 
 		featureSetToData map[string]*FeatureData
 		aliasToSet       map[string]string
@@ -42,17 +44,22 @@ type (
 	FeatureData struct {
 		cacheSignal    *int32
 		cacheTouchTime time.Time
+		// the set's ETag as of the last GET /sets
+		listedVersion string
 
 		Version  int      `json:"version"`
 		Features []string `json:"features"`
+		ETag     string   `json:"ETag,omitempty"`
 	}
 
 	SetsResponseBody struct {
-		FeatureSets []string `json:"featureSets"`
+		FeatureSets []string          `json:"featureSets"`
+		Versions    map[string]string `json:"versions"`
 	}
 
-	FeatureSetAliases struct {
-		Aliases []string `json:"aliases"`
+	AliasesResponseBody struct {
+		Aliases map[string]string `json:"aliases"`
+		ETag    string            `json:"ETag"`
 	}
 )
 
@@ -227,20 +234,38 @@ func (c *FeatureDataCache) GetFeatureSetAliases(log log15.Logger, setName string
 
 func populateFeatures(log log15.Logger, setName string, featureData *FeatureData) (success bool) {
 	featuresUrl := config.FeatureFlipperUri() + "/set/" + setName + "/features"
-	featuresRes, err := http.Get(featuresUrl)
+	req, err := http.NewRequest("GET", featuresUrl, nil)
+	if err != nil {
+		log.Error("http.NewRequest", "URL", featuresUrl, "Error", err)
+		return
+	}
+
+	// the features only change with the set's ETag. if it hasn't moved the
+	// response is a bodiless 304
+	if featureData.ETag != "" {
+		req.Header.Set("If-None-Match", featureData.ETag)
+	}
+
+	featuresRes, err := http.DefaultClient.Do(req)
 	log.Info("GET " + featuresUrl)
 	if err != nil {
 		log.Error("GET", "URL", featuresUrl, "Error", err)
 		return
 	}
 	defer featuresRes.Body.Close()
-	if featuresRes.StatusCode != 200 {
-		log.Error("GET", "URL", featuresUrl, "StatusCode", featuresRes.StatusCode)
-		return
-	}
 
-	if err = json.NewDecoder(featuresRes.Body).Decode(featureData); err != nil {
-		log.Error("json.Decode", "Error", err)
+	switch featuresRes.StatusCode {
+	case 200:
+		if err = json.NewDecoder(featuresRes.Body).Decode(featureData); err != nil {
+			log.Error("json.Decode", "Error", err)
+			return
+		}
+
+	case 304:
+		log.Debug("features unchanged", "featureSet", setName, "ETag", featureData.ETag)
+
+	default:
+		log.Error("GET", "URL", featuresUrl, "StatusCode", featuresRes.StatusCode)
 		return
 	}
 
@@ -274,56 +299,79 @@ func (c *FeatureDataCache) populateFeatureData(log log15.Logger) (success bool)
 		return
 	}
 
-	updateAliases := time.Since(c.aliasesTouchTime) >= 1*time.Hour
-	aliasToSet := make(map[string]string)
-
 	for _, featureSet := range setsResponseBody.FeatureSets {
 
-		if _, exists := c.featureSetToData[featureSet]; !exists {
+		if featureData, exists := c.featureSetToData[featureSet]; !exists {
 			c.featureSetToData[featureSet] = &FeatureData{
-				cacheSignal: new(int32),
+				cacheSignal:   new(int32),
+				listedVersion: setsResponseBody.Versions[featureSet],
 			}
+		} else if version, ok := setsResponseBody.Versions[featureSet]; ok && version != featureData.listedVersion {
+			// the set changed since the last listing. expire its features so
+			// the next read refreshes them instead of waiting out the TTL
+			log.Info("feature set changed", "featureSet", featureSet, "version", version)
+			featureData.listedVersion = version
+			featureData.cacheTouchTime = time.Time{}
 		}
+	}
 
-		// this is a table SCAN and aliases don't change often
-		if updateAliases {
-			log.Info("getting aliases for " + featureSet)
-
-			aliasesURL := config.FeatureFlipperUri() + "/set/" + featureSet + "/aliases"
-			log.Info("GET " + aliasesURL)
-			if aliasesRes, err := http.Get(aliasesURL); err != nil {
+	// aliases don't change often
+	if time.Since(c.aliasesTouchTime) >= 1*time.Hour {
+		c.populateAliases(log)
+	}
 
-				log.Error("GET", "URL", aliasesURL, "Error", err)
-			} else {
-				defer aliasesRes.Body.Close()
-				if aliasesRes.StatusCode != 200 {
-					log.Error("GET", "URL", aliasesURL, "StatusCode", aliasesRes.StatusCode)
-					continue
-				}
+	c.cacheTouchTime = time.Now()
 
-				fsa := FeatureSetAliases{}
-				if err := json.NewDecoder(aliasesRes.Body).Decode(&fsa); err != nil {
+	success = true
+	return
+}
 
-					log.Error("json.Decode", "Error", err)
-				} else {
+// populateAliases replaces aliasToSet with the alias map from GET /aliases. The
+// map's ETag is sent back so an unchanged map costs a 304
+func (c *FeatureDataCache) populateAliases(log log15.Logger) (success bool) {
+	aliasesURL := config.FeatureFlipperUri() + "/aliases"
+	req, err := http.NewRequest("GET", aliasesURL, nil)
+	if err != nil {
+		log.Error("http.NewRequest", "URL", aliasesURL, "Error", err)
+		return
+	}
 
-					// use the feature set tokens to store features
-					for _, alias := range fsa.Aliases {
-						log.Debug("Alias", "alias", alias, "featureSet", featureSet)
-						aliasToSet[alias] = featureSet
-					}
-				}
-			}
-		}
+	if c.aliasesVersion != "" {
+		req.Header.Set("If-None-Match", c.aliasesVersion)
 	}
 
-	if updateAliases {
-		c.aliasToSet = aliasToSet
-		c.aliasesTouchTime = time.Now()
+	log.Info("GET " + aliasesURL)
+	aliasesRes, err := http.DefaultClient.Do(req)
+	if err != nil {
+		log.Error("GET", "URL", aliasesURL, "Error", err)
+		return
 	}
+	defer aliasesRes.Body.Close()
 
-	c.cacheTouchTime = time.Now()
+	switch aliasesRes.StatusCode {
+	case 200:
+		aliasesResponseBody := AliasesResponseBody{}
+		if err = json.NewDecoder(aliasesRes.Body).Decode(&aliasesResponseBody); err != nil {
+			log.Error("json.Decode", "Error", err)
+			return
+		}
+
+		if aliasesResponseBody.Aliases == nil {
+			aliasesResponseBody.Aliases = make(map[string]string)
+		}
+
+		c.aliasToSet = aliasesResponseBody.Aliases
+		c.aliasesVersion = aliasesResponseBody.ETag
+
+	case 304:
+		log.Debug("aliases unchanged", "ETag", c.aliasesVersion)
+
+	default:
+		log.Error("GET", "URL", aliasesURL, "StatusCode", aliasesRes.StatusCode)
+		return
+	}
 
+	c.aliasesTouchTime = time.Now()
 	success = true
 	return
 }
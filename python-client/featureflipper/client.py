@@ -0,0 +1,166 @@
+# (c) 2016-2017 Adobe.  All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+import hashlib
+import json
+import logging
+import threading
+import time
+
+try:
+    from urllib.error import HTTPError
+    from urllib.parse import quote
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib import quote
+    from urllib2 import HTTPError, Request, urlopen
+
+log = logging.getLogger(__name__)
+
+
+class FeatureSetNotFound(Exception):
+    pass
+
+
+# Evaluates feature sets in process. The pctUsers of each set is fetched from
+# GET /set/:set_id/pct_users the first time the set is used and refreshed on a
+# background thread every refresh_interval seconds with If-None-Match, so an
+# unchanged set costs a 304. Until a refresh succeeds the last good copy is
+# served, however old it is.
+class Client(object):
+    def __init__(self, uri, refresh_interval=10, api_key=None, timeout=5):
+        # e.g. https://abcde12345.execute-api.us-west-2.amazonaws.com/prod
+        self.uri = uri.rstrip('/')
+        self.refreshInterval = refresh_interval
+        self.apiKey = api_key
+        self.timeout = timeout
+        self.sets = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # the features on for user_id, or the features on for 100% of users when
+    # user_id is None. the same as GET /set/:set_id/features?user_id=<user id>
+    def features(self, set_id, user_id=None):
+        featureSet = self.feature_set(set_id)
+        if user_id is None:
+            return featureSet.allUsers
+        return featureSet.features_for_shard(user_shard(user_id))
+
+    def is_enabled(self, set_id, feature, user_id=None):
+        return feature in self.features(set_id, user_id)
+
+    # ETag of the copy of the set being served
+    def etag(self, set_id):
+        return self.feature_set(set_id).etag
+
+    # stops the background refresh
+    def close(self):
+        self.stopped.set()
+
+    def feature_set(self, setId):
+        featureSet = self.sets.get(setId)
+        if featureSet is not None:
+            return featureSet
+
+        with self.lock:
+            featureSet = self.sets.get(setId)
+            if featureSet is None:
+                featureSet = self.fetch(setId, None)
+                self.sets[setId] = featureSet
+            self.start()
+        return featureSet
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self.refresh_loop, name='featureflipper-refresh')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def refresh_loop(self):
+        while not self.stopped.wait(self.refreshInterval):
+            self.refresh()
+
+    # refreshes every set in use. a set that fails to refresh keeps its last
+    # good copy and is retried on the next pass
+    def refresh(self):
+        for setId, current in list(self.sets.items()):
+            try:
+                featureSet = self.fetch(setId, current)
+            except FeatureSetNotFound:
+                log.warning('feature set %s no longer exists. serving ETag %s', setId, current.etag)
+                continue
+            except Exception:
+                log.exception('refreshing feature set %s failed. serving ETag %s', setId, current.etag)
+                continue
+
+            if featureSet is not current:
+                self.sets[setId] = featureSet
+
+    # GET /set/:set_id/pct_users. returns current when it's still up to date
+    def fetch(self, setId, current):
+        request = Request(self.uri + '/set/' + quote(setId, safe='') + '/pct_users')
+        request.add_header('Accept', 'application/json')
+        if self.apiKey is not None:
+            request.add_header('x-api-key', self.apiKey)
+        if current is not None:
+            request.add_header('If-None-Match', current.etag)
+
+        try:
+            response = urlopen(request, timeout=self.timeout)
+            try:
+                body = json.loads(response.read().decode('utf-8'))
+            finally:
+                response.close()
+        except HTTPError as e:
+            if e.code == 304 and current is not None:
+                current.fetchedAt = time.time()
+                return current
+            if e.code == 404:
+                raise FeatureSetNotFound(setId)
+            raise
+
+        return FeatureSet(body.get('ETag', ''), body.get('pctUsers', {}))
+
+
+class FeatureSet(object):
+    def __init__(self, etag, pctUsers):
+        self.etag = etag
+        self.fetchedAt = time.time()
+        # features on for 100% of users
+        self.allUsers = []
+        # (featureName, actualPercent) for every feature rolled out to someone
+        self.thresholds = []
+        self.shards = [None] * 100
+
+        for featureName in pctUsers:
+            if pctUsers[featureName] == 1:
+                self.allUsers.append(featureName)
+
+            actualPercent = int(pctUsers[featureName] * 100)
+            if actualPercent > 0:
+                self.thresholds.append((featureName, actualPercent))
+
+    # same rule as CompiledFeatureSet.features_for_shard in the public Lambda
+    def features_for_shard(self, shard):
+        features = self.shards[shard]
+        if features is None:
+            features = [featureName for featureName, actualPercent in self.thresholds
+                        if shard < actualPercent]
+            self.shards[shard] = features
+        return features
+
+
+# same as user_shard in the public Lambda. user ids are hashed as UTF-8
+def user_shard(user_id):
+    if not isinstance(user_id, bytes):
+        user_id = user_id.encode('utf-8')
+    return int(hashlib.md5(user_id).hexdigest(), 16) % 100
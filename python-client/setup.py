@@ -0,0 +1,19 @@
+# (c) 2016-2017 Adobe.  All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+from setuptools import setup
+
+setup(
+    name='featureflipper',
+    version='1.0.0',
+    description='In-process evaluation of Adobe Feature Flipper feature sets',
+    url='https://github.com/adobe-platform/feature-flipper',
+    license='Apache License 2.0',
+    packages=['featureflipper'],
+)
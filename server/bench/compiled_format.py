@@ -0,0 +1,83 @@
+# (c) 2016-2017 Adobe.  All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+# Compares loading a set from the msgpack Data attribute against the Compiled
+# attribute, the way the public Lambda does on a cache miss: decode, then
+# answer one request for all users and one for a user's shard.
+#
+#   python bench/compiled_format.py
+#
+# run from server/ with the Lambdas' dependencies (boto3, msgpack) installed
+from __future__ import print_function
+
+import imp
+import os
+import random
+import timeit
+
+import msgpack
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+public = imp.load_source('public_lambda_function', os.path.join(SERVER_DIR, 'public', 'lambda_function.py'))
+private = imp.load_source('private_lambda_function', os.path.join(SERVER_DIR, 'private', 'lambda_function.py'))
+
+SET_SIZES = [10, 100, 1000, 5000]
+
+
+def feature_set_data(size):
+    rand = random.Random(size)
+    features = {}
+    for i in range(size):
+        features['feature_{}_{}'.format(i, rand.randint(0, 1 << 30))] = {
+            'description': 'a feature that does something useful ' * rand.randint(1, 4),
+            'pctUsers': rand.choice([0, 0, 0.1, 0.25, 0.5, 1, 1, 1])
+        }
+    return {'version': 1, 'features': features}
+
+
+def load_data(data):
+    featureSet = public.CompiledFeatureSet('PROD-bench', '1', msgpack.loads(data))
+    featureSet.allUsersResponse
+    featureSet.response_for_shard(42)
+
+
+def load_compiled(compiled):
+    featureSet = public.CompactFeatureSet.parse('PROD-bench', '1', compiled)
+    featureSet.allUsersResponse
+    featureSet.response_for_shard(42)
+
+
+def best_of(fn, arg, number):
+    return min(timeit.repeat(lambda: fn(arg), repeat=5, number=number)) / number
+
+
+def main():
+    print('{:>8} {:>10} {:>10} {:>12} {:>12} {:>8}'.format(
+        'features', 'Data B', 'Compiled B', 'Data us', 'Compiled us', 'speedup'))
+
+    for size in SET_SIZES:
+        featureSetData = feature_set_data(size)
+        data = msgpack.dumps(featureSetData)
+        compiled = private.compile_feature_set(featureSetData)
+
+        number = max(1, 20000 // size)
+        dataSeconds = best_of(load_data, data, number)
+        compiledSeconds = best_of(load_compiled, compiled, number)
+
+        print('{:>8} {:>10} {:>10} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(
+            size, len(data), len(compiled), dataSeconds * 1e6, compiledSeconds * 1e6,
+            dataSeconds / compiledSeconds))
+
+
+if __name__ == '__main__':
+    main()
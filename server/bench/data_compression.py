@@ -0,0 +1,83 @@
+# (c) 2016-2017 Adobe.  All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+# Size and latency of zlib compressing the Data attribute against plain msgpack.
+# Read units assume an eventually consistent GetItem of the Data attribute
+# alone (0.5 per 4 KB).
+#
+#   python bench/data_compression.py
+#
+# run from server/ with the Lambdas' dependencies (boto3, msgpack) installed
+from __future__ import print_function
+
+import imp
+import math
+import os
+import random
+import timeit
+
+import msgpack
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+private = imp.load_source('private_lambda_function', os.path.join(SERVER_DIR, 'private', 'lambda_function.py'))
+
+SET_SIZES = [10, 100, 1000, 3000]
+
+WORDS = ['enable', 'the', 'new', 'comment', 'threading', 'for', 'blog', 'posts',
+         'rollout', 'owned', 'by', 'team', 'see', 'ticket', 'admin', 'ui', 'in',
+         'preview', 'only', 'until', 'launch', 'cache', 'service', 'latency']
+
+
+def feature_set_data(size):
+    rand = random.Random(size)
+    features = {}
+    for i in range(size):
+        features['feature_{}_{}'.format(i, rand.randint(0, 1 << 30))] = {
+            'description': ' '.join(rand.choice(WORDS) for _ in range(rand.randint(5, 40))),
+            'pctUsers': rand.choice([0, 0.1, 0.25, 0.5, 1])
+        }
+    return {'version': 1, 'features': features}
+
+
+def read_units(size):
+    return math.ceil(size / 4096.0) / 2
+
+
+def best_of(fn, number):
+    return min(timeit.repeat(fn, repeat=5, number=number)) / number
+
+
+def main():
+    print('{:>8} {:>10} {:>10} {:>6} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'features', 'msgpack B', 'zlib B', 'ratio', 'RCU', 'zlib RCU',
+        'encode us', 'zencode us', 'decode us', 'zdecode us'))
+
+    for size in SET_SIZES:
+        featureSetData = feature_set_data(size)
+        plain = msgpack.dumps(featureSetData)
+        compressed = private.encode_data(featureSetData)
+
+        number = max(1, 5000 // size)
+        encodePlain = best_of(lambda: msgpack.dumps(featureSetData), number)
+        encodeCompressed = best_of(lambda: private.encode_data(featureSetData), number)
+        decodePlain = best_of(lambda: private.decode_data(plain), number)
+        decodeCompressed = best_of(lambda: private.decode_data(compressed), number)
+
+        print('{:>8} {:>10} {:>10} {:>6.2f} {:>8} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            size, len(plain), len(compressed), float(len(compressed)) / len(plain),
+            read_units(len(plain)), read_units(len(compressed)),
+            encodePlain * 1e6, encodeCompressed * 1e6, decodePlain * 1e6, decodeCompressed * 1e6))
+
+
+if __name__ == '__main__':
+    main()
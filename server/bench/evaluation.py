@@ -0,0 +1,209 @@
+# (c) 2016-2017 Adobe.  All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+# Times the public Lambda's evaluation: the md5 shard of a user id,
+# get_features and get_features_for_user on a cached set, and
+# get_features_for_user when the set isn't cached yet, for sets of 10 to
+# 50,000 features. Results can be saved as JSON and compared against a saved
+# baseline, in which case the exit status is 1 if anything got slower by more
+# than --tolerance.
+#
+#   python bench/evaluation.py --output baseline.json
+#   python bench/evaluation.py --baseline baseline.json
+#
+# run from server/ with the Lambdas' dependencies (boto3, msgpack) installed.
+# timings are the best of --repeat runs in microseconds per call
+from __future__ import print_function
+
+import argparse
+import imp
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+
+sys.path.insert(0, BENCH_DIR)
+from fake_dynamodb import FakeDynamoDB
+
+public = imp.load_source('public_lambda_function', os.path.join(SERVER_DIR, 'public', 'lambda_function.py'))
+private = imp.load_source('private_lambda_function', os.path.join(SERVER_DIR, 'private', 'lambda_function.py'))
+
+# sets this large don't fit in a DynamoDB item. they're here to show how
+# evaluation scales
+SET_SIZES = [10, 100, 1000, 10000, 50000]
+
+
+def feature_set_data(size):
+    rand = random.Random(size)
+    features = {}
+    for i in range(size):
+        features['feature_{}_{}'.format(i, rand.randint(0, 1 << 30))] = {
+            'description': 'a feature that does something useful',
+            'pctUsers': rand.choice([0, 0, 0.1, 0.25, 0.5, 1, 1, 1])
+        }
+    return {'version': 1, 'features': features}
+
+
+# writes the set the way the private Lambda's PUT does
+def put_set(fake, setId, featureSetData):
+    fake.put_item(
+        TableName=public.DB_DATA_TABLE,
+        Item={
+            'FeatureSet': {'S': setId},
+            'Data': {'B': private.encode_data(featureSetData)},
+            'Compiled': {'B': private.compile_feature_set(featureSetData)},
+            'ETag': {'N': '1'}
+        })
+
+
+def clear_caches():
+    public.featureSetCache = public.LRUCache('featureSet', public.FEATURE_SET_CACHE_SIZE)
+    public.aliasCache = public.LRUCache('alias', public.ALIAS_CACHE_SIZE)
+
+
+def best_of(fn, repeat):
+    return min(timeit.repeat(fn, repeat=repeat, number=1))
+
+
+def bench_shard(userIds, repeat):
+    user_shard = public.user_shard
+
+    def run():
+        for userId in userIds:
+            user_shard(userId)
+
+    return {
+        'user_shard': best_of(run, repeat) / len(userIds),
+        'user_shards': best_of(lambda: public.user_shards(userIds), repeat) / len(userIds)
+    }
+
+
+def bench_set(size, userIds, requests, repeat):
+    setId = 'PROD-bench-{}'.format(size)
+    put_set(public.dynamodb, setId, feature_set_data(size))
+
+    allUsersReq = {'set_id': setId}
+    userReqs = [{'set_id': setId, 'user_id': userId} for userId in userIds[:requests]]
+
+    clear_caches()
+    public.get_features(allUsersReq)
+
+    def run_all_users():
+        for i in xrange(requests):
+            public.get_features(allUsersReq)
+
+    def run_users():
+        for req in userReqs:
+            public.get_features_for_user(req)
+
+    # a cache miss costs the read and decoding the set, so it's run far
+    # fewer times
+    loads = max(5, min(len(userReqs), 200000 // size))
+
+    def run_loads():
+        for req in userReqs[:loads]:
+            clear_caches()
+            public.get_features_for_user(req)
+
+    return {
+        'get_features/{}'.format(size): best_of(run_all_users, repeat) / requests,
+        'get_features_for_user/{}'.format(size): best_of(run_users, repeat) / len(userReqs),
+        'get_features_for_user_uncached/{}'.format(size): best_of(run_loads, repeat) / loads
+    }
+
+
+# get_features/10 before get_features/100
+def sort_key(name):
+    parts = name.split('/')
+    if len(parts) == 1:
+        return (name, 0)
+    return (parts[0], int(parts[1]))
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print()
+    print('{:<40} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline us', 'current us', 'change'))
+    for name in sorted(results, key=sort_key):
+        if name not in baseline:
+            continue
+        change = results[name] / baseline[name] - 1
+        flag = ''
+        if change > tolerance:
+            flag = ' SLOWER'
+            regressions.append(name)
+        print('{:<40} {:>12.3f} {:>12.3f} {:>+7.1f}%{}'.format(
+            name, baseline[name], results[name], change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000000, help='user ids to shard')
+    parser.add_argument('--requests', type=int, default=100000, help='calls per set size')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SET_SIZES),
+                        help='comma separated set sizes')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against results saved with --output')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fraction slower than the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    public.dynamodb = FakeDynamoDB()
+    # uncached means read from DynamoDB, not from the Lambda's disk cache
+    public.DISK_CACHE_DIR = ''
+    # log lines would be timed too
+    public.requestLog = public.RequestLog({}, None)
+
+    rand = random.Random(0)
+    userIds = ['user-{}'.format(rand.randint(0, 1 << 40)) for _ in xrange(args.users)]
+
+    # microseconds per call
+    results = {}
+    for name, seconds in bench_shard(userIds, args.repeat).items():
+        results[name] = seconds * 1e6
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for name, seconds in bench_set(size, userIds, min(args.requests, args.users), args.repeat).items():
+            results[name] = seconds * 1e6
+
+    print('{:<40} {:>12}'.format('benchmark', 'us per call'))
+    for name in sorted(results, key=sort_key):
+        print('{:<40} {:>12.3f}'.format(name, results[name]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'users': args.users,
+                'requests': args.requests,
+                'results': results
+            }, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print('\n{} regression(s) over {:.0f}%'.format(len(regressions), args.tolerance * 100))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
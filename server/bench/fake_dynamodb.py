@@ -0,0 +1,495 @@
+# (c) 2016-2017 Adobe.  All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+# An in-process stand-in for the boto3 DynamoDB client calls the Lambdas make.
+# It understands the tables, index and expressions the Lambdas use rather than
+# all of DynamoDB. Every call is counted, can be delayed to simulate network
+# latency and can be throttled. Consumed capacity is estimated from item sizes
+# when a call asks for it.
+#
+#   fake = FakeDynamoDB(latency=0.005)
+#   lambda_function.dynamodb = lambda_function.TimedClient(fake)
+from __future__ import print_function
+
+import copy
+import math
+import random
+import re
+import time
+
+from botocore.exceptions import ClientError
+
+# table -> (hash key, range key or None)
+KEY_SCHEMAS = {
+    'FeatureFlipper': ('FeatureSet', None),
+    'FeatureFlipperAliases': ('Alias', None),
+    'FeatureFlipperChanges': ('Feed', 'Sequence'),
+}
+
+# index -> hash key of the index
+INDEXES = {
+    'FeatureSet-index': 'FeatureSet',
+}
+
+OPERATIONS = ['get_item', 'batch_get_item', 'scan', 'query', 'put_item', 'update_item', 'delete_item']
+
+OPERATION_NAMES = {
+    'get_item': 'GetItem',
+    'batch_get_item': 'BatchGetItem',
+    'scan': 'Scan',
+    'query': 'Query',
+    'put_item': 'PutItem',
+    'update_item': 'UpdateItem',
+    'delete_item': 'DeleteItem'
+}
+
+
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class FakeDynamoDB(object):
+    # latency is seconds added to every call, or a dict of operation to seconds.
+    # throttle is the fraction of calls, and of BatchGetItem keys, that are
+    # throttled
+    def __init__(self, latency=0, throttle=0):
+        self.latency = latency
+        self.throttle = throttle
+        self.random = random.Random(0)
+        self.tables = dict((tableName, {}) for tableName in KEY_SCHEMAS)
+        self.calls = dict((operation, 0) for operation in OPERATIONS)
+
+    def reset_calls(self):
+        for operation in self.calls:
+            self.calls[operation] = 0
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def get_item(self, **kwargs):
+        self.call('get_item')
+        tableName = kwargs['TableName']
+        item = self.tables[tableName].get(self.key(tableName, kwargs['Key']))
+
+        res = {}
+        if item is not None:
+            res['Item'] = project(item, kwargs)
+        self.read_capacity(res, kwargs, tableName, [item])
+        return res
+
+    # like DynamoDB, throttled keys come back in UnprocessedKeys and the call
+    # only fails when every key is throttled
+    def batch_get_item(self, **kwargs):
+        self.call('batch_get_item', throttled=False)
+        responses = {}
+        unprocessed = {}
+        capacity = []
+        keyCount = 0
+        for tableName, keysAndAttributes in kwargs['RequestItems'].items():
+            if len(keysAndAttributes['Keys']) > 100:
+                raise client_error('ValidationException', 'BatchGetItem', 'Too many items requested')
+
+            keys = []
+            for key in keysAndAttributes['Keys']:
+                keyCount += 1
+                if self.throttled():
+                    unprocessed.setdefault(tableName, dict(keysAndAttributes, Keys=[]))['Keys'].append(key)
+                else:
+                    keys.append(key)
+
+            items = [self.tables[tableName].get(self.key(tableName, key)) for key in keys]
+            responses[tableName] = [project(item, keysAndAttributes) for item in items if item is not None]
+            capacity.append(read_units(tableName, items, keysAndAttributes))
+
+        if keyCount > 0 and sum(len(keysAndAttributes['Keys']) for keysAndAttributes in unprocessed.values()) == keyCount:
+            raise client_error('ProvisionedThroughputExceededException', 'BatchGetItem')
+
+        res = {'Responses': responses, 'UnprocessedKeys': unprocessed}
+        if wants_capacity(kwargs):
+            res['ConsumedCapacity'] = capacity
+        return res
+
+    def scan(self, **kwargs):
+        self.call('scan')
+        tableName = kwargs['TableName']
+        keys = self.keys_after(tableName, kwargs.get('ExclusiveStartKey'))
+        limit = kwargs.get('Limit')
+
+        res = {'Items': []}
+        evaluated = []
+        for key in keys:
+            if limit is not None and len(evaluated) == limit:
+                res['LastEvaluatedKey'] = self.key_attributes(tableName, evaluated[-1])
+                break
+
+            item = self.tables[tableName][key]
+            evaluated.append(item)
+            if 'FilterExpression' in kwargs and not condition(kwargs['FilterExpression'], item, kwargs):
+                continue
+            res['Items'].append(project(item, kwargs))
+
+        res['Count'] = len(res['Items'])
+        self.read_capacity(res, kwargs, tableName, evaluated)
+        return res
+
+    # supports hash = :value with an optional comparison on the range key, on
+    # a table or on one of INDEXES
+    def query(self, **kwargs):
+        self.call('query')
+        tableName = kwargs['TableName']
+        parts = split(kwargs['KeyConditionExpression'], ' AND ')
+
+        match = re.match(r'^\s*([#\w]+)\s*=\s*(:\w+)\s*$', parts[0])
+        hashName = path(match.group(1), kwargs)[0]
+        hashValue = kwargs['ExpressionAttributeValues'][match.group(2)]
+        rangeCondition = parts[1] if len(parts) > 1 else None
+
+        if 'IndexName' in kwargs and INDEXES[kwargs['IndexName']] != hashName:
+            raise client_error('ValidationException', 'Query', 'Query condition missed key schema element')
+
+        keys = self.keys_after(tableName, kwargs.get('ExclusiveStartKey'))
+        limit = kwargs.get('Limit')
+
+        res = {'Items': []}
+        matched = []
+        for key in keys:
+            item = self.tables[tableName][key]
+            if item.get(hashName) != hashValue:
+                continue
+            if rangeCondition is not None and not condition(rangeCondition, item, kwargs):
+                continue
+            if limit is not None and len(matched) == limit:
+                res['LastEvaluatedKey'] = self.key_attributes(tableName, matched[-1])
+                break
+            matched.append(item)
+            res['Items'].append(project(item, kwargs))
+
+        res['Count'] = len(res['Items'])
+        self.read_capacity(res, kwargs, tableName, matched)
+        return res
+
+    def put_item(self, **kwargs):
+        self.call('put_item')
+        tableName = kwargs['TableName']
+        key = self.key(tableName, kwargs['Item'])
+        old = self.tables[tableName].get(key)
+
+        if 'ConditionExpression' in kwargs and not condition(kwargs['ConditionExpression'], old or {}, kwargs):
+            raise client_error('ConditionalCheckFailedException', 'PutItem')
+
+        self.tables[tableName][key] = copy.deepcopy(kwargs['Item'])
+
+        res = {}
+        if kwargs.get('ReturnValues') == 'ALL_OLD' and old is not None:
+            res['Attributes'] = old
+        self.write_capacity(res, kwargs, tableName, [old, kwargs['Item']])
+        return res
+
+    def delete_item(self, **kwargs):
+        self.call('delete_item')
+        tableName = kwargs['TableName']
+        key = self.key(tableName, kwargs['Key'])
+        old = self.tables[tableName].get(key)
+
+        if 'ConditionExpression' in kwargs and not condition(kwargs['ConditionExpression'], old or {}, kwargs):
+            raise client_error('ConditionalCheckFailedException', 'DeleteItem')
+
+        self.tables[tableName].pop(key, None)
+
+        res = {}
+        if kwargs.get('ReturnValues') == 'ALL_OLD' and old is not None:
+            res['Attributes'] = old
+        self.write_capacity(res, kwargs, tableName, [old])
+        return res
+
+    def update_item(self, **kwargs):
+        self.call('update_item')
+        tableName = kwargs['TableName']
+        key = self.key(tableName, kwargs['Key'])
+        old = self.tables[tableName].get(key)
+
+        if 'ConditionExpression' in kwargs and not condition(kwargs['ConditionExpression'], old or {}, kwargs):
+            raise client_error('ConditionalCheckFailedException', 'UpdateItem')
+
+        if old is not None:
+            item = copy.deepcopy(old)
+        else:
+            item = copy.deepcopy(kwargs['Key'])
+        update(kwargs['UpdateExpression'], item, kwargs)
+        self.tables[tableName][key] = item
+
+        res = {}
+        returnValues = kwargs.get('ReturnValues', 'NONE')
+        if returnValues in ['ALL_NEW', 'UPDATED_NEW']:
+            res['Attributes'] = copy.deepcopy(item)
+        elif returnValues == 'ALL_OLD' and old is not None:
+            res['Attributes'] = old
+        self.write_capacity(res, kwargs, tableName, [old, item])
+        return res
+
+    def call(self, operation, throttled=True):
+        self.calls[operation] += 1
+
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(operation, 0)
+        if latency > 0:
+            time.sleep(latency)
+
+        if throttled and self.throttled():
+            raise client_error('ProvisionedThroughputExceededException', OPERATION_NAMES[operation])
+
+    def throttled(self):
+        return self.throttle > 0 and self.random.random() < self.throttle
+
+    def key(self, tableName, attributes):
+        hashKey, rangeKey = KEY_SCHEMAS[tableName]
+        if rangeKey is None:
+            return scalar(attributes[hashKey])
+        return (scalar(attributes[hashKey]), scalar(attributes[rangeKey]))
+
+    def key_attributes(self, tableName, item):
+        hashKey, rangeKey = KEY_SCHEMAS[tableName]
+        attributes = {hashKey: item[hashKey]}
+        if rangeKey is not None:
+            attributes[rangeKey] = item[rangeKey]
+        return attributes
+
+    # keys of a table in order, after startKey when it's given
+    def keys_after(self, tableName, startKey):
+        keys = sorted(self.tables[tableName])
+        if startKey is not None:
+            start = self.key(tableName, startKey)
+            keys = [key for key in keys if key > start]
+        return keys
+
+    def read_capacity(self, res, kwargs, tableName, items):
+        if wants_capacity(kwargs):
+            res['ConsumedCapacity'] = read_units(tableName, items, kwargs)
+
+    def write_capacity(self, res, kwargs, tableName, items):
+        if wants_capacity(kwargs):
+            size = max([item_size(item) for item in items if item is not None] or [0])
+            res['ConsumedCapacity'] = {
+                'TableName': tableName,
+                'CapacityUnits': max(1.0, math.ceil(size / 1024.0))
+            }
+
+
+def wants_capacity(kwargs):
+    return kwargs.get('ReturnConsumedCapacity', 'NONE') in ['TOTAL', 'INDEXES']
+
+
+# reads cost a unit per 4 KB of item read, rounded up per item for gets and
+# over the total for scans and queries. half that when eventually consistent
+def read_units(tableName, items, kwargs):
+    sizes = [item_size(item) for item in items if item is not None]
+    units = sum(max(1.0, math.ceil(size / 4096.0)) for size in sizes) or 1.0
+    if not kwargs.get('ConsistentRead', False):
+        units /= 2
+    return {'TableName': tableName, 'CapacityUnits': units}
+
+
+def item_size(item):
+    return sum(len(name) + value_size(value) for name, value in item.items())
+
+
+def value_size(value):
+    if 'S' in value or 'B' in value:
+        return len(value.get('S', value.get('B')))
+    if 'N' in value:
+        return len(value['N'])
+    if 'M' in value:
+        return 3 + item_size(value['M'])
+    return 1
+
+
+def scalar(value):
+    if 'S' in value:
+        return value['S']
+    if 'N' in value:
+        return float(value['N'])
+    if 'B' in value:
+        return value['B']
+    raise ValueError(value)
+
+
+def number(f):
+    if f == int(f):
+        return str(int(f))
+    return str(f)
+
+
+def path(expression, kwargs):
+    names = kwargs.get('ExpressionAttributeNames', {})
+    return [names.get(part, part) for part in expression.strip().split('.')]
+
+
+def get(item, attributePath):
+    value = item
+    for i, part in enumerate(attributePath):
+        if i > 0:
+            if value is None or 'M' not in value:
+                return None
+            value = value['M']
+        if part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def project(item, kwargs):
+    if 'ProjectionExpression' not in kwargs:
+        return copy.deepcopy(item)
+
+    projected = {}
+    for expression in kwargs['ProjectionExpression'].split(','):
+        name = path(expression, kwargs)[0]
+        if name in item:
+            projected[name] = copy.deepcopy(item[name])
+    return projected
+
+
+# splits expression on sep outside of parentheses
+def split(expression, sep):
+    parts = []
+    depth = 0
+    current = ''
+    i = 0
+    while i < len(expression):
+        c = expression[i]
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        if depth == 0 and expression[i:i + len(sep)] == sep:
+            parts.append(current)
+            current = ''
+            i += len(sep)
+            continue
+        current += c
+        i += 1
+    parts.append(current)
+    return parts
+
+
+def compare(a, op, b):
+    if a is None or b is None:
+        return op == '<>' and a != b
+    a = scalar(a)
+    b = scalar(b)
+    return {
+        '=': a == b,
+        '<>': a != b,
+        '<': a < b,
+        '<=': a <= b,
+        '>': a > b,
+        '>=': a >= b
+    }[op]
+
+
+def condition(expression, item, kwargs):
+    expression = expression.strip()
+
+    ors = split(expression, ' OR ')
+    if len(ors) > 1:
+        return any(condition(e, item, kwargs) for e in ors)
+
+    ands = split(expression, ' AND ')
+    if len(ands) > 1:
+        return all(condition(e, item, kwargs) for e in ands)
+
+    if expression.startswith('(') and expression.endswith(')'):
+        return condition(expression[1:-1], item, kwargs)
+
+    match = re.match(r'^(attribute_not_exists|attribute_exists)\((.+)\)$', expression)
+    if match:
+        exists = get(item, path(match.group(2), kwargs)) is not None
+        if match.group(1) == 'attribute_exists':
+            return exists
+        return not exists
+
+    match = re.match(r'^([#\w.]+)\s*(=|<>|<=|>=|<|>)\s*(:\w+)$', expression)
+    if match:
+        value = kwargs['ExpressionAttributeValues'][match.group(3)]
+        return compare(get(item, path(match.group(1), kwargs)), match.group(2), value)
+
+    raise NotImplementedError(expression)
+
+
+def operand(expression, item, kwargs):
+    expression = expression.strip()
+
+    match = re.match(r'^if_not_exists\((.+),(.+)\)$', expression)
+    if match:
+        current = get(item, path(match.group(1), kwargs))
+        if current is not None:
+            return current
+        return operand(match.group(2), item, kwargs)
+
+    terms = split(expression, '+')
+    if len(terms) == 2:
+        a = operand(terms[0], item, kwargs)
+        b = operand(terms[1], item, kwargs)
+        return {'N': number(float(a['N']) + float(b['N']))}
+
+    if expression.startswith(':'):
+        return copy.deepcopy(kwargs['ExpressionAttributeValues'][expression])
+    return copy.deepcopy(get(item, path(expression, kwargs)))
+
+
+# like DynamoDB, setting a.b fails when a doesn't exist
+def set_path(item, attributePath, value):
+    target = item
+    for part in attributePath[:-1]:
+        if part not in target or 'M' not in target[part]:
+            raise client_error('ValidationException', 'UpdateItem',
+                               'The document path provided in the update expression is invalid for update')
+        target = target[part]['M']
+    target[attributePath[-1]] = value
+
+
+def remove_path(item, attributePath):
+    target = item
+    for part in attributePath[:-1]:
+        if part not in target or 'M' not in target[part]:
+            return
+        target = target[part]['M']
+    target.pop(attributePath[-1], None)
+
+
+def update(expression, item, kwargs):
+    action = None
+    for token in re.split(r'\b(SET|REMOVE|ADD|DELETE)\b', expression):
+        token = token.strip()
+        if token in ['SET', 'REMOVE', 'ADD', 'DELETE']:
+            action = token
+            continue
+        if token == '':
+            continue
+
+        for part in split(token, ','):
+            part = part.strip()
+            if action == 'SET':
+                name, value = part.split('=', 1)
+                set_path(item, path(name, kwargs), operand(value, item, kwargs))
+            elif action == 'REMOVE':
+                remove_path(item, path(part, kwargs))
+            elif action == 'ADD':
+                name, value = part.split()
+                attributePath = path(name, kwargs)
+                current = get(item, attributePath)
+                add = kwargs['ExpressionAttributeValues'][value]
+                if current is None:
+                    set_path(item, attributePath, copy.deepcopy(add))
+                else:
+                    set_path(item, attributePath, {'N': number(float(current['N']) + float(add['N']))})
+            else:
+                raise NotImplementedError(action)
@@ -0,0 +1,299 @@
+# (c) 2016-2017 Adobe.  All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+# Drives both Lambdas' lambda_handler end to end against the DynamoDB stand-in
+# in fake_dynamodb.py, the way API Gateway calls them, and reports requests per
+# second, p50 and p99 latency and DynamoDB calls per request for each scenario.
+# Sets are created and filled through the private Lambda first so the items
+# are the ones it writes.
+#
+#   python bench/lambdas.py [--requests 2000] [--latency-ms 0] [--throttle 0] [--scenario features]
+#
+# run from server/ with the Lambdas' dependencies (boto3, msgpack) installed.
+# --latency-ms adds that much to every DynamoDB call and --throttle throttles
+# that fraction of them
+from __future__ import print_function
+
+import argparse
+import imp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+
+sys.path.insert(0, BENCH_DIR)
+from fake_dynamodb import FakeDynamoDB
+
+public = imp.load_source('public_lambda_function', os.path.join(SERVER_DIR, 'public', 'lambda_function.py'))
+private = imp.load_source('private_lambda_function', os.path.join(SERVER_DIR, 'private', 'lambda_function.py'))
+
+# set name -> number of features
+SETS = [
+    ('PROD-small', 10),
+    ('PROD-medium', 100),
+    ('PROD-large', 1000),
+]
+
+ALIAS = 'PROD-current'
+
+WORDS = ['enable', 'the', 'new', 'comment', 'threading', 'for', 'blog', 'posts',
+         'rollout', 'owned', 'by', 'team', 'see', 'ticket', 'admin', 'ui', 'in',
+         'preview', 'only', 'until', 'launch', 'cache', 'service', 'latency']
+
+
+class Context(object):
+    aws_request_id = 'bench'
+
+
+class Scenario(object):
+    # request(i) returns the i-th request. before(), when given, runs untimed
+    # ahead of each request
+    def __init__(self, name, function, request, before=None, env={}):
+        self.name = name
+        self.function = function
+        self.request = request
+        self.before = before
+        self.env = env
+
+
+def features(size, rand):
+    featureData = {}
+    for i in range(size):
+        featureData['feature_{}'.format(i)] = {
+            'description': ' '.join(rand.choice(WORDS) for _ in range(rand.randint(5, 20))),
+            'pctUsers': rand.choice([0, 0.1, 0.25, 0.5, 1, 1])
+        }
+    return featureData
+
+
+def call(function, req):
+    try:
+        function.lambda_handler(req, Context())
+        return '200'
+    except function.HTTPError as e:
+        return e.status_code
+
+
+def seed(rand):
+    etags = {}
+    for setId, size in SETS:
+        call(private, {'http_method': 'POST', 'resource_path': '/set', 'body': {'channelSet': setId}})
+        status = call(private, {
+            'http_method': 'PUT',
+            'resource_path': '/set/{set_id}',
+            'set_id': setId,
+            'headers': {'if-match': '1'},
+            'body': {'features': features(size, rand)}
+        })
+        if status != '200':
+            raise Exception('seeding {} failed with {}'.format(setId, status))
+        etags[setId] = '2'
+
+    call(private, {
+        'http_method': 'POST',
+        'resource_path': '/set/{set_id}/aliases',
+        'set_id': 'PROD-medium',
+        'body': {'alias_id': ALIAS}
+    })
+    return etags
+
+
+# a runtime restarted in the same container. the disk cache is kept
+def restart_public():
+    public.featureSetCache = public.LRUCache('featureSet', public.FEATURE_SET_CACHE_SIZE)
+    public.aliasCache = public.LRUCache('alias', public.ALIAS_CACHE_SIZE)
+    public.setsCache = None
+    public.aliasesCache = None
+
+
+# a new container
+def clear_public_caches():
+    restart_public()
+    shutil.rmtree(public.DISK_CACHE_DIR, ignore_errors=True)
+
+
+def scenarios(fake, etags):
+    result = []
+
+    def get_features(setId, **params):
+        return lambda i: dict({'http_method': 'GET', 'resource_path': '/set/{set_id}/features', 'set_id': setId},
+                              **params)
+
+    for setId, size in SETS:
+        result += [
+            Scenario('features all users {}'.format(size), public, get_features(setId)),
+            Scenario('features user {}'.format(size), public,
+                     lambda i, setId=setId: get_features(setId, user_id='user-{}'.format(i))(i)),
+            Scenario('features user {} revalidate'.format(size), public,
+                     lambda i, setId=setId: get_features(setId, user_id='user-{}'.format(i))(i),
+                     env={'FEATURE_SET_CACHE_TTL': 0}),
+            Scenario('features user {} cold'.format(size), public,
+                     lambda i, setId=setId: get_features(setId, user_id='user-{}'.format(i))(i),
+                     before=clear_public_caches),
+            Scenario('features user {} restart'.format(size), public,
+                     lambda i, setId=setId: get_features(setId, user_id='user-{}'.format(i))(i),
+                     before=restart_public),
+        ]
+
+    result += [
+        Scenario('features not modified 100', public,
+                 get_features('PROD-medium', headers={'if-none-match': etags['PROD-medium']})),
+        Scenario('features alias 100', public, lambda i: get_features(ALIAS, user_id='user-{}'.format(i))(i)),
+        Scenario('shard features 100', public, lambda i: {
+            'http_method': 'GET',
+            'resource_path': '/set/{set_id}/shard/{shard}/features',
+            'set_id': 'PROD-medium',
+            'shard': str(i % 100)
+        }),
+        Scenario('batch 100 users 100', public, lambda i: {
+            'http_method': 'POST',
+            'resource_path': '/set/{set_id}/features',
+            'set_id': 'PROD-medium',
+            'body': {'user_ids': ['user-{}-{}'.format(i, j) for j in range(100)]}
+        }),
+        Scenario('sets features 3', public, lambda i: {
+            'http_method': 'GET',
+            'resource_path': '/sets/features',
+            'set_ids': ','.join(setId for setId, _ in SETS),
+            'user_id': 'user-{}'.format(i)
+        }),
+        Scenario('public sets', public, lambda i: {'http_method': 'GET', 'resource_path': '/sets'}),
+        Scenario('private get set 100', private, lambda i: {
+            'http_method': 'GET',
+            'resource_path': '/set/{set_id}',
+            'set_id': 'PROD-medium'
+        }),
+        Scenario('private put set 100', private, put_set_request(fake, 'PROD-medium')),
+        Scenario('private sets', private, lambda i: {'http_method': 'GET', 'resource_path': '/sets'}),
+    ]
+    return result
+
+
+# each PUT sends the set's current ETag as If-Match
+def put_set_request(fake, setId):
+    rand = random.Random(setId)
+    featureData = features(dict(SETS)[setId], rand)
+
+    def request(i):
+        etag = fake.tables[private.DB_DATA_TABLE][setId]['ETag']['N']
+        return {
+            'http_method': 'PUT',
+            'resource_path': '/set/{set_id}',
+            'set_id': setId,
+            'headers': {'if-match': etag},
+            'body': {'features': dict(featureData)}
+        }
+    return request
+
+
+def percentile(sortedValues, p):
+    return sortedValues[int(round(p * (len(sortedValues) - 1)))]
+
+
+def run(scenario, fake, requests):
+    saved = {}
+    for name, value in scenario.env.items():
+        saved[name] = getattr(scenario.function, name)
+        setattr(scenario.function, name, value)
+
+    # warm the caches and let the first request's one off costs out of the way
+    for i in range(min(10, requests)):
+        if scenario.before is not None:
+            scenario.before()
+        call(scenario.function, scenario.request(i))
+
+    fake.reset_calls()
+    latencies = []
+    errors = 0
+    for i in range(requests):
+        req = scenario.request(i)
+        if scenario.before is not None:
+            scenario.before()
+
+        start = timeit.default_timer()
+        status = call(scenario.function, req)
+        latencies.append(timeit.default_timer() - start)
+
+        if status not in ['200', '304']:
+            errors += 1
+
+    for name, value in saved.items():
+        setattr(scenario.function, name, value)
+
+    latencies.sort()
+    return {
+        'opsPerSecond': len(latencies) / sum(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'dynamodbCalls': float(fake.total_calls()) / requests,
+        'errors': errors
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000, help='timed requests per scenario')
+    parser.add_argument('--latency-ms', type=float, default=0, help='added to every DynamoDB call')
+    parser.add_argument('--throttle', type=float, default=0, help='fraction of DynamoDB calls throttled')
+    parser.add_argument('--scenario', default='', help='only run scenarios whose name contains this')
+    args = parser.parse_args()
+
+    fake = FakeDynamoDB(latency=args.latency_ms / 1000.0)
+    public.DISK_CACHE_DIR = tempfile.mkdtemp()
+    public.dynamodb = public.TimedClient(fake)
+    private.dynamodb = private.TimedClient(fake)
+
+    # the Lambdas log a line per request and print tracebacks for 4xx. keep
+    # the cost, drop the output
+    stdout = sys.stdout
+    stderr = sys.stderr
+    devnull = open(os.devnull, 'w')
+
+    print('{:<32} {:>10} {:>10} {:>10} {:>10} {:>7}'.format(
+        'scenario', 'req/s', 'p50 ms', 'p99 ms', 'ddb/req', 'errors'))
+
+    sys.stdout = sys.stderr = devnull
+    try:
+        etags = seed(random.Random(0))
+    finally:
+        sys.stdout = stdout
+        sys.stderr = stderr
+
+    # only once the sets exist
+    fake.throttle = args.throttle
+
+    try:
+        for scenario in scenarios(fake, etags):
+            if args.scenario not in scenario.name:
+                continue
+
+            sys.stdout = sys.stderr = devnull
+            try:
+                result = run(scenario, fake, args.requests)
+            finally:
+                sys.stdout = stdout
+                sys.stderr = stderr
+
+            print('{:<32} {:>10.0f} {:>10.3f} {:>10.3f} {:>10.2f} {:>7}'.format(
+                scenario.name, result['opsPerSecond'], result['p50'] * 1e3, result['p99'] * 1e3,
+                result['dynamodbCalls'], result['errors']))
+    finally:
+        shutil.rmtree(public.DISK_CACHE_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
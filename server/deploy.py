@@ -10,6 +10,7 @@
 import boto3
 import json
 import os
+import time
 
 dynamodb = boto3.client('dynamodb')
 autoscaling = boto3.client('application-autoscaling')
@@ -101,7 +102,7 @@ def ensure_tables():
         )
 
     try:
-        dynamodb.describe_table(TableName='FeatureFlipperAliases')
+        ffa = dynamodb.describe_table(TableName='FeatureFlipperAliases')
         print('FeatureFlipperAliases DynamoDB table exists')
     except dynamodb.exceptions.ResourceNotFoundException:
         print('creating FeatureFlipperAliases DynamoDB table')
@@ -112,6 +113,10 @@ def ensure_tables():
                     'AttributeName': 'Alias',
                     'AttributeType': 'S'
                 },
+                {
+                    'AttributeName': 'FeatureSet',
+                    'AttributeType': 'S'
+                },
             ],
             KeySchema=[
                 {
@@ -119,11 +124,127 @@ def ensure_tables():
                     'KeyType': 'HASH'
                 },
             ],
+            GlobalSecondaryIndexes=[
+                ALIAS_SET_INDEX
+            ],
             ProvisionedThroughput={
                 'ReadCapacityUnits': 1,
                 'WriteCapacityUnits': 1
             },
         )
+        ffa = dynamodb.describe_table(TableName='FeatureFlipperAliases')
+
+    ensure_alias_set_index(ffa)
+
+    try:
+        dynamodb.describe_table(TableName='FeatureFlipperChanges')
+        print('FeatureFlipperChanges DynamoDB table exists')
+    except dynamodb.exceptions.ResourceNotFoundException:
+        print('creating FeatureFlipperChanges DynamoDB table')
+        dynamodb.create_table(
+            TableName='FeatureFlipperChanges',
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'Feed',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'Sequence',
+                    'AttributeType': 'N'
+                },
+            ],
+            KeySchema=[
+                {
+                    'AttributeName': 'Feed',
+                    'KeyType': 'HASH'
+                },
+                {
+                    'AttributeName': 'Sequence',
+                    'KeyType': 'RANGE'
+                },
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 1,
+                'WriteCapacityUnits': 1
+            },
+        )
+        dynamodb.get_waiter('table_exists').wait(TableName='FeatureFlipperChanges')
+
+    ensure_changes_ttl()
+
+
+# lets the Lambdas query the aliases of a set instead of scanning every alias
+ALIAS_SET_INDEX = {
+    'IndexName': 'FeatureSet-index',
+    'KeySchema': [
+        {
+            'AttributeName': 'FeatureSet',
+            'KeyType': 'HASH'
+        },
+    ],
+    'Projection': {
+        'ProjectionType': 'KEYS_ONLY'
+    },
+    'ProvisionedThroughput': {
+        'ReadCapacityUnits': 1,
+        'WriteCapacityUnits': 1
+    }
+}
+
+
+def ensure_alias_set_index(ffa):
+    indexes = ffa['Table'].get('GlobalSecondaryIndexes', [])
+    if ALIAS_SET_INDEX['IndexName'] in [index['IndexName'] for index in indexes]:
+        print('FeatureFlipperAliases {} index exists'.format(ALIAS_SET_INDEX['IndexName']))
+    else:
+        print('creating FeatureFlipperAliases {} index'.format(ALIAS_SET_INDEX['IndexName']))
+        dynamodb.update_table(
+            TableName='FeatureFlipperAliases',
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'FeatureSet',
+                    'AttributeType': 'S'
+                },
+            ],
+            GlobalSecondaryIndexUpdates=[
+                {
+                    'Create': ALIAS_SET_INDEX
+                },
+            ],
+        )
+
+    # the Lambdas query this index as soon as they're deployed. wait for it to
+    # finish backfilling
+    status = None
+    while True:
+        ffa = dynamodb.describe_table(TableName='FeatureFlipperAliases')
+        for index in ffa['Table'].get('GlobalSecondaryIndexes', []):
+            if index['IndexName'] == ALIAS_SET_INDEX['IndexName']:
+                status = index['IndexStatus']
+
+        if status == 'ACTIVE':
+            break
+
+        print('waiting for {} index to become ACTIVE ({})'.format(ALIAS_SET_INDEX['IndexName'], status))
+        time.sleep(10)
+
+
+# the private Lambda sets ExpiresAt on every change it records so old changes
+# fall out of the feed on their own
+def ensure_changes_ttl():
+    ttl = dynamodb.describe_time_to_live(TableName='FeatureFlipperChanges')
+    if ttl['TimeToLiveDescription']['TimeToLiveStatus'] in ['ENABLED', 'ENABLING']:
+        print('FeatureFlipperChanges TTL is enabled')
+        return
+
+    print('enabling FeatureFlipperChanges TTL on ExpiresAt')
+    dynamodb.update_time_to_live(
+        TableName='FeatureFlipperChanges',
+        TimeToLiveSpecification={
+            'Enabled': True,
+            'AttributeName': 'ExpiresAt'
+        }
+    )
 
 
 def ensure_lambda_role():
@@ -149,54 +270,62 @@ def ensure_lambda_role():
             }''',
         )
 
-    try:
-        iam.get_role_policy(
-            RoleName='feature_flipper_lambda',
-            PolicyName='dynamodb',
-        )
-        print('feature_flipper_lambda role has needed inline policy')
-    except iam.exceptions.NoSuchEntityException:
-        ff = dynamodb.describe_table(TableName='FeatureFlipper')
-        ffa = dynamodb.describe_table(TableName='FeatureFlipperAliases')
-
-        policy_doc = json.dumps({
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Action": [
-                        "dynamodb:DeleteItem",
-                        "dynamodb:GetItem",
-                        "dynamodb:PutItem",
-                        "dynamodb:Query",
-                        "dynamodb:Scan",
-                        "dynamodb:UpdateItem"
-                    ],
-                    "Effect": "Allow",
-                    "Resource": [
-                        ff['Table']['TableArn'],
-                        ffa['Table']['TableArn']
-                    ]
-                },
-                {
-                    "Resource": "*",
-                    "Action": [
-                        "logs:CreateLogGroup",
-                        "logs:CreateLogStream",
-                        "logs:PutLogEvents"
-                    ],
-                    "Effect": "Allow"
-                }
-            ]
-        }, indent=2)
+    # the inline policy is always rewritten so deployments pick up actions
+    # that new handlers need
+    ff = dynamodb.describe_table(TableName='FeatureFlipper')
+    ffa = dynamodb.describe_table(TableName='FeatureFlipperAliases')
+    ffc = dynamodb.describe_table(TableName='FeatureFlipperChanges')
+
+    policy_doc = json.dumps({
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Action": [
+                    "dynamodb:BatchGetItem",
+                    "dynamodb:DeleteItem",
+                    "dynamodb:GetItem",
+                    "dynamodb:PutItem",
+                    "dynamodb:Query",
+                    "dynamodb:Scan",
+                    "dynamodb:UpdateItem"
+                ],
+                "Effect": "Allow",
+                "Resource": [
+                    ff['Table']['TableArn'],
+                    ffa['Table']['TableArn'],
+                    ffa['Table']['TableArn'] + '/index/*',
+                    ffc['Table']['TableArn']
+                ]
+            },
+            {
+                "Action": [
+                    "s3:DeleteObject",
+                    "s3:PutObject",
+                    "s3:PutObjectAcl"
+                ],
+                "Effect": "Allow",
+                "Resource": "arn:aws:s3:::{}/snapshots/*".format(s3_bucket)
+            },
+            {
+                "Resource": "*",
+                "Action": [
+                    "logs:CreateLogGroup",
+                    "logs:CreateLogStream",
+                    "logs:PutLogEvents"
+                ],
+                "Effect": "Allow"
+            }
+        ]
+    }, indent=2)
 
-        print('attaching inline policy to role feature_flipper_lambda')
-        print(policy_doc)
+    print('attaching inline policy to role feature_flipper_lambda')
+    print(policy_doc)
 
-        iam.put_role_policy(
-            RoleName='feature_flipper_lambda',
-            PolicyName='dynamodb',
-            PolicyDocument=policy_doc,
-        )
+    iam.put_role_policy(
+        RoleName='feature_flipper_lambda',
+        PolicyName='dynamodb',
+        PolicyDocument=policy_doc,
+    )
 
 
 def ensure_autoscaling_role():
@@ -221,57 +350,53 @@ def ensure_autoscaling_role():
             }''',
         )
 
-    try:
-        iam.get_role_policy(
-            RoleName='feature_flipper_autoscaling',
-            PolicyName='dynamodb',
-        )
-        print('feature_flipper_autoscaling role has needed inline policy')
-    except iam.exceptions.NoSuchEntityException:
-        ff = dynamodb.describe_table(TableName='FeatureFlipper')
-        ffa = dynamodb.describe_table(TableName='FeatureFlipperAliases')
-
-        policy_doc = json.dumps({
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "cloudwatch:PutMetricAlarm",
-                        "cloudwatch:DescribeAlarms",
-                        "cloudwatch:DeleteAlarms"
-                    ],
-                    "Resource": "*"
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "dynamodb:DescribeTable",
-                        "dynamodb:UpdateTable"
-                    ],
-                    "Resource": [
-                        ff['Table']['TableArn'],
-                        ffa['Table']['TableArn']
-                    ]
-                }
-            ]
-        }, indent=2)
+    # the inline policy is always rewritten so new tables are covered
+    ff = dynamodb.describe_table(TableName='FeatureFlipper')
+    ffa = dynamodb.describe_table(TableName='FeatureFlipperAliases')
+    ffc = dynamodb.describe_table(TableName='FeatureFlipperChanges')
+
+    policy_doc = json.dumps({
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "cloudwatch:PutMetricAlarm",
+                    "cloudwatch:DescribeAlarms",
+                    "cloudwatch:DeleteAlarms"
+                ],
+                "Resource": "*"
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "dynamodb:DescribeTable",
+                    "dynamodb:UpdateTable"
+                ],
+                "Resource": [
+                    ff['Table']['TableArn'],
+                    ffa['Table']['TableArn'],
+                    ffc['Table']['TableArn']
+                ]
+            }
+        ]
+    }, indent=2)
 
-        print('attaching inline policy to role feature_flipper_autoscaling')
-        print(policy_doc)
+    print('attaching inline policy to role feature_flipper_autoscaling')
+    print(policy_doc)
 
-        iam.put_role_policy(
-            RoleName='feature_flipper_autoscaling',
-            PolicyName='dynamodb',
-            PolicyDocument=policy_doc,
-        )
+    iam.put_role_policy(
+        RoleName='feature_flipper_autoscaling',
+        PolicyName='dynamodb',
+        PolicyDocument=policy_doc,
+    )
 
 
 def ensure_autoscaling():
     role = iam.get_role(RoleName='feature_flipper_autoscaling')
     role_arn = role['Role']['Arn']
     read_settings = {
-        'ScalableDimension': 'dynamodb:table:ReadCapacityUnits',
+        'ScalableDimension': 'dynamodb:{}:ReadCapacityUnits',
         'PredefinedMetricType': 'DynamoDBReadCapacityUtilization',
         'MinCapacity': 1,
         'MaxCapacity': 500,
@@ -279,40 +404,47 @@ def ensure_autoscaling():
         'ScaleOutCooldown': 60,
     }
     write_settings = {
-        'ScalableDimension': 'dynamodb:table:WriteCapacityUnits',
+        'ScalableDimension': 'dynamodb:{}:WriteCapacityUnits',
         'PredefinedMetricType': 'DynamoDBWriteCapacityUtilization',
         'MinCapacity': 1,
         'MaxCapacity': 50,
         'ScaleInCooldown': 60,
         'ScaleOutCooldown': 60,
     }
-    for resource_id in ['table/FeatureFlipper', 'table/FeatureFlipperAliases']:
+    resources = [
+        ('table/FeatureFlipper', 'table'),
+        ('table/FeatureFlipperAliases', 'table'),
+        ('table/FeatureFlipperAliases/index/' + ALIAS_SET_INDEX['IndexName'], 'index'),
+        ('table/FeatureFlipperChanges', 'table'),
+    ]
+    for resource_id, resource_type in resources:
         for setting in [read_settings, write_settings]:
+            scalable_dimension = setting['ScalableDimension'].format(resource_type)
             scalable_target = autoscaling.describe_scalable_targets(
                 ServiceNamespace='dynamodb',
                 ResourceIds=[resource_id],
-                ScalableDimension=setting['ScalableDimension'],
+                ScalableDimension=scalable_dimension,
                 MaxResults=1
             )
             if len(scalable_target['ScalableTargets']) == 1:
-                print("found scalable target for {} {}".format(resource_id, setting['ScalableDimension']))
+                print("found scalable target for {} {}".format(resource_id, scalable_dimension))
             else:
-                print("creating scalable target for {} {}".format(resource_id, setting['ScalableDimension']))
+                print("creating scalable target for {} {}".format(resource_id, scalable_dimension))
                 autoscaling.register_scalable_target(
                     ServiceNamespace='dynamodb',
                     ResourceId=resource_id,
-                    ScalableDimension=setting['ScalableDimension'],
+                    ScalableDimension=scalable_dimension,
                     MinCapacity=setting['MinCapacity'],
                     MaxCapacity=setting['MaxCapacity'],
                     RoleARN=role_arn
                 )
 
-            print("put scale policy for {} {}".format(resource_id, setting['ScalableDimension']))
+            print("put scale policy for {} {}".format(resource_id, scalable_dimension))
             autoscaling.put_scaling_policy(
                 PolicyName=setting['PredefinedMetricType'],
                 ServiceNamespace='dynamodb',
                 ResourceId=resource_id,
-                ScalableDimension=setting['ScalableDimension'],
+                ScalableDimension=scalable_dimension,
                 PolicyType='TargetTrackingScaling',
                 TargetTrackingScalingPolicyConfiguration={
                     'TargetValue': 80.0,
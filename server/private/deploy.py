@@ -25,6 +25,8 @@ REQUEST_TEMPLATE = '''{
     "if-match": "$input.params().header.get('If-Match')"
   },
   "set_id": "$input.params('set_id')",
+  "limit": "$input.params('limit')",
+  "cursor": "$input.params('cursor')",
   "alias_id": "$input.params('alias_id')"
 }'''
 
@@ -34,6 +36,7 @@ httpStatuses = [200, 400, 404, 409, 500]
 
 
 def deploy():
+    ensure_lambda_environment()
     restApiId = ensure_api()
     ensure_resources(restApiId)
     ensure_lambda_permission(restApiId)
@@ -103,7 +106,9 @@ def create_route(restApiId, parentId, path, httpMethods):
     print("creating route", path, httpMethods)
 
     requestParameters = {
-        "method.request.header.If-Match": False
+        "method.request.header.If-Match": False,
+        "method.request.querystring.cursor": False,
+        "method.request.querystring.limit": False
     }
 
     if len(path) > 0 and path[0] == ":":
@@ -284,6 +289,25 @@ def corsIntegrationResponseParameters(responseParameters):
     return responseParameters
 
 
+# the function publishes snapshots to the bucket the SPA is served from.
+# variables set on the function by hand are kept
+def ensure_lambda_environment():
+    config = lambdaClient.get_function_configuration(FunctionName=FUNCTION_NAME)
+    variables = config.get('Environment', {}).get('Variables', {})
+    if variables.get('SNAPSHOT_BUCKET') == os.environ['S3_BUCKET']:
+        print("SNAPSHOT_BUCKET is set")
+        return
+
+    variables['SNAPSHOT_BUCKET'] = os.environ['S3_BUCKET']
+    print("setting SNAPSHOT_BUCKET to", variables['SNAPSHOT_BUCKET'])
+    lambdaClient.update_function_configuration(
+        FunctionName=FUNCTION_NAME,
+        Environment={
+            'Variables': variables
+        }
+    )
+
+
 def ensure_lambda_permission(restApiId):
     # e.g. arn:aws:lambda:us-west-2:123456789012:function:function-name
     functionArnParts = functionArn.split(':')
@@ -11,9 +11,16 @@ from __future__ import print_function
 
 import boto3
 import botocore
+import errno
+import json
 import msgpack
+import os
 import re
+import struct
+import time
 import traceback
+import urllib
+import zlib
 
 print('Loading function')
 
@@ -21,9 +28,70 @@ dynamodb = boto3.client('dynamodb')
 
 DB_DATA_TABLE = 'FeatureFlipper'
 DB_ALIAS_TABLE = 'FeatureFlipperAliases'
+# global secondary index on FeatureSet, created by server/deploy.py
+DB_ALIAS_SET_INDEX = 'FeatureSet-index'
+DB_CHANGES_TABLE = 'FeatureFlipperChanges'
+
+# every write is recorded in DB_CHANGES_TABLE under the CHANGE_FEED partition
+# with a sequence number taken from the counter item in the
+# CHANGE_SEQUENCE_FEED partition. DynamoDB expires records after
+# CHANGES_RETENTION seconds
+CHANGE_FEED = 'changes'
+CHANGE_SEQUENCE_FEED = 'sequence'
+CHANGES_RETENTION = int(os.environ.get('CHANGES_RETENTION', str(7 * 24 * 60 * 60)))
+
+# key of the item in DB_DATA_TABLE that lists every set and its ETag. it can't
+# collide with a set name since those must match the channelSet regex in
+# post_set
+SET_INDEX_KEY = '.index'
+
+# GET /sets walks every page of the table unless a limit is given. the full
+# listing is cached briefly and dropped whenever this container adds or
+# removes a set
+SETS_CACHE_TTL = float(os.environ.get('SETS_CACHE_TTL', '5'))
+SETS_MAX_LIMIT = 1000
+
+# after every write the affected sets and aliases are published as compiled
+# JSON snapshots that clients can read straight from S3 instead of calling the
+# public API. SNAPSHOT_BUCKET is set by private/deploy.py. SNAPSHOT_DIR writes
+# the same objects to a local directory instead
+SNAPSHOT_BUCKET = os.environ.get('SNAPSHOT_BUCKET', '')
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '')
+SNAPSHOT_PREFIX = 'snapshots/'
+# Cache-Control max-age of snapshots/sets/<set>.json and
+# snapshots/aliases/<alias>.json. snapshots/sets/<set>/<ETag>.json never change
+SNAPSHOT_MAX_AGE = int(os.environ.get('SNAPSHOT_MAX_AGE', '10'))
+
+# one JSON line is logged per request with the time spent in each phase,
+# DynamoDB calls and consumed capacity, cache hits and misses, and the size of
+# the feature data read or written. REQUEST_LOG=0 turns it off
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') != '0'
+# made once rather than by json.dumps for every line. sort_keys would make it
+# use json's pure python encoder
+logEncoder = json.JSONEncoder(separators=(',', ':'))
+
+# CAPACITY_ACCOUNTING=1 asks DynamoDB for the capacity every call consumes and
+# sums it per route, feature set and table across the invocations of the
+# container. the sums are logged as one JSON line every CAPACITY_FLUSH_EVERY
+# invocations
+CAPACITY_ACCOUNTING = os.environ.get('CAPACITY_ACCOUNTING', '0') == '1'
+CAPACITY_FLUSH_EVERY = int(os.environ.get('CAPACITY_FLUSH_EVERY', '100'))
+WRITE_OPERATIONS = ['put_item', 'update_item', 'delete_item']
 
 VERSION = 1
 
+# Data is msgpack, zlib compressed behind DATA_ZLIB_MARKER when that's smaller.
+# msgpack never produces the byte 0xc1 so older uncompressed items are still
+# told apart
+DATA_ZLIB_MARKER = '\xc1'
+DATA_ZLIB_LEVEL = 6
+
+# sets are also stored in the Compiled attribute in a format the public API can
+# evaluate without decoding Data. see compile_feature_set
+COMPILED_MAGIC = 'FFC'
+COMPILED_VERSION = 1
+COMPILED_ALL_USERS = 0x80
+
 DEFAULT_SET = {
     "version": VERSION,
     "features": {}
@@ -31,14 +99,24 @@ DEFAULT_SET = {
 
 
 def lambda_handler(req, context):
+    global requestLog
+    requestLog = RequestLog(req, context)
+    status = '200'
     try:
-        return handle_request(req)
+        res = handle_request(req)
+        return res
     except HTTPError, e:
+        status = e.status_code
         traceback.print_exc()
         raise e
     except Exception, e:
+        status = '500'
         traceback.print_exc()
         s500()
+    finally:
+        requestLog.emit(status)
+        if CAPACITY_ACCOUNTING:
+            capacityAccount.record(requestLog)
 
 
 def handle_request(req):
@@ -49,7 +127,6 @@ def handle_request(req):
     if 'resource_path' not in req:
         s400()
 
-    print(req['http_method'] + ' ' + req['resource_path'])
     if req['http_method'] == "GET":
 
         if req['resource_path'] == "/set/{set_id}":
@@ -84,58 +161,208 @@ def handle_request(req):
 
 
 def get_sets(req):
-    scanRes = dynamodb.scan(
+    limit = request_limit(req)
+    if limit is None:
+        featureSets, versions = list_feature_sets()
+        return {'featureSets': featureSets, 'versions': versions}
+
+    cursor = None
+    if 'cursor' in req and req['cursor'] != "":
+        cursor = req['cursor']
+
+    featureSets, versions, cursor = get_feature_sets_page(limit, cursor)
+    res = {'featureSets': featureSets, 'versions': versions}
+    if cursor is not None:
+        res['cursor'] = cursor
+    return res
+
+
+def request_limit(req):
+    if 'limit' not in req or req['limit'] == "":
+        return None
+
+    try:
+        limit = int(req['limit'])
+    except ValueError:
+        s400()
+
+    if limit < 1 or limit > SETS_MAX_LIMIT:
+        s400()
+
+    return limit
+
+
+# every set name and its ETag. the listing is cached in the container for
+# SETS_CACHE_TTL seconds
+def list_feature_sets():
+    global setsCache
+
+    now = time.time()
+    if setsCache is not None and now - setsCache.fetchedAt < SETS_CACHE_TTL:
+        requestLog.count('cache.sets.hit')
+        return setsCache.value
+
+    requestLog.count('cache.sets.miss')
+    versions = get_set_index()
+    if versions is None:
+        versions = {}
+        cursor = None
+        while True:
+            pageVersions, cursor = scan_feature_sets(None, cursor)
+            versions.update(pageVersions)
+            if cursor is None:
+                break
+
+    setsCache = CacheEntry((sorted(versions), versions), None, now)
+    return setsCache.value
+
+
+# one page of set names, their ETags and the cursor for the next page, which is
+# None on the last page
+def get_feature_sets_page(limit, cursor):
+    versions = get_set_index()
+    if versions is None:
+        versions, cursor = scan_feature_sets(limit, cursor)
+        return sorted(versions), versions, cursor
+
+    featureSets = sorted(versions)
+    if cursor is not None:
+        featureSets = [featureSet for featureSet in featureSets if featureSet > cursor]
+
+    cursor = None
+    if len(featureSets) > limit:
+        featureSets = featureSets[:limit]
+        cursor = featureSets[-1]
+
+    pageVersions = {}
+    for featureSet in featureSets:
+        pageVersions[featureSet] = versions[featureSet]
+
+    return featureSets, pageVersions, cursor
+
+
+# the set index item maintained by the private API's write paths. returns a
+# dict of set name to ETag or None if the index hasn't been built yet
+def get_set_index():
+    getIndexRes = dynamodb.get_item(
         TableName=DB_DATA_TABLE,
-        Select='SPECIFIC_ATTRIBUTES',
-        ReturnConsumedCapacity='NONE',
-        ProjectionExpression='FeatureSet',
-        ConsistentRead=False
+        Key={
+            'FeatureSet': {
+                'S': SET_INDEX_KEY
+            }
+        },
+        ConsistentRead=False,
+        ReturnConsumedCapacity='NONE'
     )
 
+    if 'Item' not in getIndexRes:
+        return None
+
+    item = getIndexRes['Item']
+    if 'Sets' not in item or 'M' not in item['Sets']:
+        return None
+
+    versions = {}
+    for featureSet, etag in item['Sets']['M'].iteritems():
+        versions[featureSet] = etag.get('N', '')
+
+    return versions
+
+
+# a page of the table scan used while there's no set index. returns a dict of
+# set name to ETag and the cursor for the next page
+def scan_feature_sets(limit, cursor):
+    scanArgs = {
+        'TableName': DB_DATA_TABLE,
+        'Select': 'SPECIFIC_ATTRIBUTES',
+        'ReturnConsumedCapacity': 'NONE',
+        'ProjectionExpression': 'FeatureSet, #etag',
+        'ExpressionAttributeNames': {
+            '#etag': 'ETag'
+        },
+        'ConsistentRead': False
+    }
+
+    if limit is not None:
+        scanArgs['Limit'] = limit
+
+    if cursor is not None:
+        scanArgs['ExclusiveStartKey'] = {
+            'FeatureSet': {
+                'S': cursor
+            }
+        }
+
+    scanRes = dynamodb.scan(**scanArgs)
+
     if 'Items' not in scanRes:
         s404()
 
-    featureSets = []
+    versions = {}
     for item in scanRes['Items']:
         if 'FeatureSet' in item and 'S' in item['FeatureSet']:
-            featureSets.append(item['FeatureSet']['S'])
+            if item['FeatureSet']['S'] == SET_INDEX_KEY:
+                continue
+            if 'ETag' in item and 'N' in item['ETag']:
+                versions[item['FeatureSet']['S']] = item['ETag']['N']
+            else:
+                versions[item['FeatureSet']['S']] = ''
 
-    return {'featureSets': featureSets}
+    cursor = None
+    if 'LastEvaluatedKey' in scanRes:
+        cursor = scanRes['LastEvaluatedKey']['FeatureSet']['S']
+
+    return versions, cursor
 
 
 def get_set_aliases(req):
-    scanRes = dynamodb.scan(
-        TableName=DB_ALIAS_TABLE,
-        Select='SPECIFIC_ATTRIBUTES',
-        ReturnConsumedCapacity='NONE',
-        ProjectionExpression='Alias',
-        FilterExpression='#fs = :fs',
-        ExpressionAttributeNames={
+    if 'set_id' not in req:
+        s400()
+
+    return {'aliases': query_set_aliases(req['set_id'])}
+
+
+# every alias of setId via the FeatureSet index on the alias table, so the cost
+# follows the number of aliases of this set rather than all aliases
+def query_set_aliases(setId):
+    queryArgs = {
+        'TableName': DB_ALIAS_TABLE,
+        'IndexName': DB_ALIAS_SET_INDEX,
+        'Select': 'SPECIFIC_ATTRIBUTES',
+        'ReturnConsumedCapacity': 'NONE',
+        'ProjectionExpression': 'Alias',
+        'KeyConditionExpression': '#fs = :fs',
+        'ExpressionAttributeNames': {
             '#fs': 'FeatureSet'
         },
-        ExpressionAttributeValues={
+        'ExpressionAttributeValues': {
             ':fs': {
-                'S': req['set_id']
+                'S': setId
             }
-        },
-        ConsistentRead=False
-    )
-
-    if 'Items' not in scanRes:
-        s404()
+        }
+    }
 
     aliases = []
-    for item in scanRes['Items']:
-        if 'Alias' in item and 'S' in item['Alias']:
-            aliases.append(item['Alias']['S'])
+    while True:
+        queryRes = dynamodb.query(**queryArgs)
+
+        for item in queryRes.get('Items', []):
+            if 'Alias' in item and 'S' in item['Alias']:
+                aliases.append(item['Alias']['S'])
 
-    return {'aliases': aliases}
+        if 'LastEvaluatedKey' not in queryRes:
+            return aliases
+
+        queryArgs['ExclusiveStartKey'] = queryRes['LastEvaluatedKey']
 
 
 def get_set(req):
     if 'set_id' not in req:
         s400()
 
+    if req['set_id'] == SET_INDEX_KEY:
+        s404()
+
     getItemRes = dynamodb.get_item(
         TableName=DB_DATA_TABLE,
         Key={
@@ -143,6 +370,11 @@ def get_set(req):
                 'S': req['set_id']
             }
         },
+        ProjectionExpression='#data, #etag',
+        ExpressionAttributeNames={
+            '#data': 'Data',
+            '#etag': 'ETag'
+        },
         ConsistentRead=True,
         ReturnConsumedCapacity='NONE'
     )
@@ -150,7 +382,8 @@ def get_set(req):
     if 'Item' in getItemRes:
         item = getItemRes['Item']
         if 'Data' in item and 'B' in item['Data']:
-            res = msgpack.loads(item['Data']['B'])
+            requestLog.add_bytes('dataBytes', len(item['Data']['B']))
+            res = decode_data(item['Data']['B'])
             if 'ETag' in item and 'N' in item['ETag']:
                 res['ETag'] = item['ETag']['N']
             return res
@@ -199,6 +432,11 @@ def put_set(req):
 
     featureData['version'] = VERSION
 
+    with requestLog.phase('encode'):
+        data = encode_data(featureData)
+        compiled = compile_feature_set(featureData)
+    requestLog.add_bytes('dataBytes', len(data) + len(compiled))
+
     try:
         newETag = str(int(req['headers']['if-match']) + 1)
         dynamodb.update_item(
@@ -211,15 +449,19 @@ def put_set(req):
             ReturnValues='NONE',
             ReturnConsumedCapacity='NONE',
             ReturnItemCollectionMetrics='NONE',
-            UpdateExpression='SET #data=:data, #etag=:etag',
+            UpdateExpression='SET #data=:data, #compiled=:compiled, #etag=:etag',
             ConditionExpression='#etag = :ifmatch',
             ExpressionAttributeNames={
                 '#data': 'Data',
+                '#compiled': 'Compiled',
                 '#etag': 'ETag'
             },
             ExpressionAttributeValues={
                 ':data': {
-                    'B': msgpack.dumps(featureData)
+                    'B': data
+                },
+                ':compiled': {
+                    'B': compiled
                 },
                 ':ifmatch': {
                     'N': req['headers']['if-match']
@@ -230,8 +472,6 @@ def put_set(req):
             }
         )
 
-        return {'ETag': newETag}
-
     # https://github.com/boto/botocore/blob/80cc4c39e6c4f24f85ef376569a59ca2e74fd9ea/botocore/exceptions.py#L325
     except botocore.exceptions.ClientError as e:
         if 'Error' in e.response and 'Code' in e.response['Error'] and e.response['Error']['Code'] == 'ConditionalCheckFailedException':
@@ -239,6 +479,12 @@ def put_set(req):
         else:
             raise e
 
+    update_set_index(req['set_id'], newETag)
+    record_change('set', req['set_id'], 'update', {'ETag': newETag})
+    publish_set_snapshot(req['set_id'], newETag, featureData)
+
+    return {'ETag': newETag}
+
 
 def delete_set(req):
     if 'set_id' not in req:
@@ -274,40 +520,27 @@ def delete_set(req):
     if 'Attributes' not in deleteItemRes:
         s404()
 
-    scanRes = dynamodb.scan(
-        TableName=DB_ALIAS_TABLE,
-        Select='SPECIFIC_ATTRIBUTES',
-        ReturnConsumedCapacity='NONE',
-        ProjectionExpression='Alias',
-        FilterExpression='#fs = :fs',
-        ExpressionAttributeNames={
-            '#fs': 'FeatureSet'
-        },
-        ExpressionAttributeValues={
-            ':fs': {
-                'S': req['set_id']
-            }
-        },
-        ConsistentRead=True
-    )
+    remove_from_set_index(req['set_id'])
+    invalidate_sets_cache()
+    record_change('set', req['set_id'], 'delete')
+    remove_snapshot(set_snapshot_key(req['set_id']))
 
-    if 'Items' not in scanRes:
-        return
-
-    for item in scanRes['Items']:
-        if 'Alias' in item and 'S' in item['Alias']:
-            alias = item['Alias']['S']
-            dynamodb.delete_item(
-                TableName=DB_ALIAS_TABLE,
-                Key={
-                    'Alias': {
-                        'S': alias
-                    }
-                },
-                ReturnValues='NONE',
-                ReturnConsumedCapacity='NONE',
-                ReturnItemCollectionMetrics='NONE'
-            )
+    # the index is eventually consistent so an alias created moments ago may be
+    # left behind. it resolves to a set that no longer exists, which is a 404
+    for alias in query_set_aliases(req['set_id']):
+        dynamodb.delete_item(
+            TableName=DB_ALIAS_TABLE,
+            Key={
+                'Alias': {
+                    'S': alias
+                }
+            },
+            ReturnValues='NONE',
+            ReturnConsumedCapacity='NONE',
+            ReturnItemCollectionMetrics='NONE'
+        )
+        record_change('alias', alias, 'delete', {'FeatureSet': req['set_id']})
+        remove_snapshot(alias_snapshot_key(alias))
 
 
 def post_set(req):
@@ -322,7 +555,10 @@ def post_set(req):
     if not re.match('^\w+\-[A-Za-z](\w|\-)*$', channelSet):
         s400()
 
-    dataStr = msgpack.dumps(DEFAULT_SET)
+    with requestLog.phase('encode'):
+        dataStr = encode_data(DEFAULT_SET)
+        compiled = compile_feature_set(DEFAULT_SET)
+    requestLog.add_bytes('dataBytes', len(dataStr) + len(compiled))
 
     try:
         dynamodb.put_item(
@@ -334,6 +570,9 @@ def post_set(req):
                 'Data': {
                     'B': dataStr
                 },
+                'Compiled': {
+                    'B': compiled
+                },
                 'ETag': {
                     'N': '1'
                 }
@@ -349,6 +588,11 @@ def post_set(req):
         else:
             raise e
 
+    update_set_index(channelSet, '1')
+    invalidate_sets_cache()
+    record_change('set', channelSet, 'create', {'ETag': '1'})
+    publish_set_snapshot(channelSet, '1', DEFAULT_SET)
+
 
 def post_alias(req):
     if 'set_id' not in req:
@@ -360,6 +604,9 @@ def post_alias(req):
     if 'alias_id' not in req['body']:
         s400()
 
+    if req['set_id'] == SET_INDEX_KEY:
+        s404()
+
     getItemRes = dynamodb.get_item(
         TableName=DB_DATA_TABLE,
         Key={
@@ -397,6 +644,9 @@ def post_alias(req):
         else:
             raise e
 
+    record_change('alias', req['body']['alias_id'], 'create', {'FeatureSet': req['set_id']})
+    publish_alias_snapshot(req['body']['alias_id'], req['set_id'])
+
 
 def delete_alias(req):
     if 'alias_id' not in req:
@@ -417,10 +667,652 @@ def delete_alias(req):
     if 'Attributes' not in deleteItemRes:
         s404()
 
+    attributes = deleteItemRes['Attributes']
+    if 'FeatureSet' in attributes and 'S' in attributes['FeatureSet']:
+        record_change('alias', req['alias_id'], 'delete', {'FeatureSet': attributes['FeatureSet']['S']})
+    else:
+        record_change('alias', req['alias_id'], 'delete')
+    remove_snapshot(alias_snapshot_key(req['alias_id']))
+
+
+# appends a change to the change feed. kind is 'set' or 'alias', op is
+# 'create', 'update' or 'delete' and details are extra string attributes such
+# as the new ETag of a set or the set an alias points to.
+#
+# the change itself has already been written, so a failure is logged and
+# counted rather than answered with a 500, and the change is missing from the
+# feed. taking the next sequence number and writing the change are two calls.
+# when only the second fails, GET /changes stops in front of the gap for up to
+# CHANGES_SETTLE_SECONDS after the next change and then skips it
+def record_change(kind, itemId, op, details={}):
+    try:
+        write_change(kind, itemId, op, details)
+    except Exception:
+        requestLog.count('changes.failed')
+        traceback.print_exc()
+
+
+def write_change(kind, itemId, op, details):
+    sequenceRes = dynamodb.update_item(
+        TableName=DB_CHANGES_TABLE,
+        Key={
+            'Feed': {
+                'S': CHANGE_SEQUENCE_FEED
+            },
+            'Sequence': {
+                'N': '0'
+            }
+        },
+        ReturnValues='UPDATED_NEW',
+        ReturnConsumedCapacity='NONE',
+        ReturnItemCollectionMetrics='NONE',
+        UpdateExpression='ADD #value :one',
+        ExpressionAttributeNames={
+            '#value': 'Value'
+        },
+        ExpressionAttributeValues={
+            ':one': {
+                'N': '1'
+            }
+        }
+    )
+
+    now = int(time.time())
+    item = {
+        'Feed': {
+            'S': CHANGE_FEED
+        },
+        'Sequence': sequenceRes['Attributes']['Value'],
+        'Type': {
+            'S': kind
+        },
+        'Id': {
+            'S': itemId
+        },
+        'Op': {
+            'S': op
+        },
+        'CreatedAt': {
+            'N': str(now)
+        },
+        'ExpiresAt': {
+            'N': str(now + CHANGES_RETENTION)
+        }
+    }
+
+    for k in details:
+        item[k] = {
+            'S': details[k]
+        }
+
+    dynamodb.put_item(
+        TableName=DB_CHANGES_TABLE,
+        Item=item,
+        ReturnValues='NONE',
+        ReturnConsumedCapacity='NONE',
+        ReturnItemCollectionMetrics='NONE'
+    )
+
+
+# records the ETag of a set in the set index so GET /sets is a single get_item.
+# the set itself has already been written, so a failure is logged and counted
+# rather than answered with a 500. GET /sets lists the set with its previous
+# ETag until the set is written again
+def update_set_index(setId, etag):
+    try:
+        write_set_index(setId, etag)
+    except Exception:
+        requestLog.count('setIndex.failed')
+        traceback.print_exc()
+
+
+# an ETag older than the one already recorded is ignored
+def write_set_index(setId, etag, buildIndex=True):
+    try:
+        dynamodb.update_item(
+            TableName=DB_DATA_TABLE,
+            Key={
+                'FeatureSet': {
+                    'S': SET_INDEX_KEY
+                }
+            },
+            ReturnValues='NONE',
+            ReturnConsumedCapacity='NONE',
+            ReturnItemCollectionMetrics='NONE',
+            UpdateExpression='SET #sets.#set = :etag',
+            ConditionExpression='attribute_not_exists(#sets.#set) OR #sets.#set < :etag',
+            ExpressionAttributeNames={
+                '#sets': 'Sets',
+                '#set': setId
+            },
+            ExpressionAttributeValues={
+                ':etag': {
+                    'N': etag
+                }
+            }
+        )
+    except botocore.exceptions.ClientError as e:
+        code = error_code(e)
+        if code == 'ConditionalCheckFailedException':
+            return
+        elif code == 'ValidationException' and buildIndex:
+            # the index item doesn't exist yet. building it from a consistent
+            # scan picks up this write too
+            if not build_set_index():
+                write_set_index(setId, etag, False)
+        else:
+            raise e
+
+
+# like update_set_index a failure is logged rather than failing the delete,
+# which leaves the deleted set in GET /sets
+def remove_from_set_index(setId):
+    try:
+        dynamodb.update_item(
+            TableName=DB_DATA_TABLE,
+            Key={
+                'FeatureSet': {
+                    'S': SET_INDEX_KEY
+                }
+            },
+            ReturnValues='NONE',
+            ReturnConsumedCapacity='NONE',
+            ReturnItemCollectionMetrics='NONE',
+            UpdateExpression='REMOVE #sets.#set',
+            ConditionExpression='attribute_exists(#sets)',
+            ExpressionAttributeNames={
+                '#sets': 'Sets',
+                '#set': setId
+            }
+        )
+    except botocore.exceptions.ClientError as e:
+        # no index yet. it'll be built without this set on the next write
+        if error_code(e) != 'ConditionalCheckFailedException':
+            requestLog.count('setIndex.failed')
+            traceback.print_exc()
+    except Exception:
+        requestLog.count('setIndex.failed')
+        traceback.print_exc()
+
+
+# creates the set index from a scan of the table. returns False if another
+# writer created it first
+def build_set_index():
+    versions = {}
+    scanArgs = {
+        'TableName': DB_DATA_TABLE,
+        'Select': 'SPECIFIC_ATTRIBUTES',
+        'ReturnConsumedCapacity': 'NONE',
+        'ProjectionExpression': 'FeatureSet, #etag',
+        'ExpressionAttributeNames': {
+            '#etag': 'ETag'
+        },
+        'ConsistentRead': True
+    }
+
+    while True:
+        scanRes = dynamodb.scan(**scanArgs)
+
+        for item in scanRes.get('Items', []):
+            if item['FeatureSet']['S'] == SET_INDEX_KEY:
+                continue
+            # listed with an empty ETag, as scan_feature_sets does. such a set
+            # can't be written through the API so its entry never changes
+            if 'ETag' in item and 'N' in item['ETag']:
+                versions[item['FeatureSet']['S']] = item['ETag']
+            else:
+                versions[item['FeatureSet']['S']] = {'S': ''}
+
+        if 'LastEvaluatedKey' not in scanRes:
+            break
+
+        scanArgs['ExclusiveStartKey'] = scanRes['LastEvaluatedKey']
+
+    try:
+        dynamodb.put_item(
+            TableName=DB_DATA_TABLE,
+            Item={
+                'FeatureSet': {
+                    'S': SET_INDEX_KEY
+                },
+                'Sets': {
+                    'M': versions
+                }
+            },
+            ConditionExpression='attribute_not_exists(FeatureSet)',
+            ReturnValues='NONE',
+            ReturnConsumedCapacity='NONE',
+            ReturnItemCollectionMetrics='NONE'
+        )
+        return True
+    except botocore.exceptions.ClientError as e:
+        if error_code(e) == 'ConditionalCheckFailedException':
+            return False
+        raise e
+
+
+# snapshots/sets/<set>/<ETag>.json is written first and never changes, then
+# snapshots/sets/<set>.json is overwritten with the same body. the write to
+# DynamoDB already succeeded so a failure here is logged rather than returned.
+# the next write to the set publishes it again
+def publish_set_snapshot(setId, etag, featureSetData):
+    store = snapshot_store()
+    if store is None:
+        return
+
+    with requestLog.phase('snapshot'):
+        try:
+            body = json.dumps(compile_snapshot(setId, etag, featureSetData), separators=(',', ':'))
+            store.put(SNAPSHOT_PREFIX + 'sets/' + urllib.quote(setId, safe='') + '/' + etag + '.json', body,
+                      'max-age=31536000, immutable')
+            store.put(set_snapshot_key(setId), body, 'max-age=' + str(SNAPSHOT_MAX_AGE))
+        except Exception:
+            traceback.print_exc()
+
+
+def publish_alias_snapshot(alias, setId):
+    store = snapshot_store()
+    if store is None:
+        return
+
+    with requestLog.phase('snapshot'):
+        try:
+            body = json.dumps({'alias': alias, 'featureSet': setId}, separators=(',', ':'))
+            store.put(alias_snapshot_key(alias), body, 'max-age=' + str(SNAPSHOT_MAX_AGE))
+        except Exception:
+            traceback.print_exc()
+
+
+def remove_snapshot(key):
+    store = snapshot_store()
+    if store is None:
+        return
+
+    with requestLog.phase('snapshot'):
+        try:
+            store.delete(key)
+        except Exception:
+            traceback.print_exc()
+
+
+# set and alias names are escaped so a / in an alias can't change the path
+def set_snapshot_key(setId):
+    return SNAPSHOT_PREFIX + 'sets/' + urllib.quote(setId, safe='') + '.json'
+
+
+def alias_snapshot_key(alias):
+    return SNAPSHOT_PREFIX + 'aliases/' + urllib.quote(alias, safe='') + '.json'
+
+
+# the features on for 100% of users plus the features on for each of the 100
+# user shards. a user's shard is int(md5(user_id).hexdigest(), 16) % 100, the
+# same as the public API
+def compile_snapshot(setId, etag, featureSetData):
+    allUsers = []
+    thresholds = []
+
+    features = featureSetData.get('features', {})
+    for featureName in sorted(features):
+        featureData = features[featureName]
+
+        if 'pctUsers' not in featureData:
+            continue
+
+        if featureData['pctUsers'] == 1:
+            allUsers.append(featureName)
+
+        actualPercent = int(featureData['pctUsers'] * 100)
+        if actualPercent > 0:
+            thresholds.append((featureName, actualPercent))
+
+    shards = []
+    for shard in range(100):
+        shards.append([name for name, percent in thresholds if shard < percent])
+
+    return {
+        'featureSet': setId,
+        'ETag': etag,
+        'allUsers': allUsers,
+        'shards': shards
+    }
+
+
+def encode_data(featureSetData):
+    data = msgpack.dumps(featureSetData)
+    compressed = DATA_ZLIB_MARKER + zlib.compress(data, DATA_ZLIB_LEVEL)
+    if len(compressed) < len(data):
+        return compressed
+    return data
+
+
+def decode_data(data):
+    if data[:1] == DATA_ZLIB_MARKER:
+        data = zlib.decompress(data[1:])
+    return msgpack.loads(data)
+
+
+# encodes what the public API needs to evaluate a set. all integers are big
+# endian
+#
+#   'FFC' + version byte
+#   uint32 feature count n
+#   n threshold bytes. the low 7 bits are int(pctUsers * 100) clamped to
+#     [0,100] and COMPILED_ALL_USERS is set when pctUsers == 1
+#   n + 1 uint32 offsets of each UTF-8 feature name in the names that follow.
+#     name i is names[offsets[i]:offsets[i + 1]]
+#   names
+#
+# features are ordered by percent, highest first, and features on for all users
+# come first among those at 100. the features on for all users and the features
+# on for any shard are then a prefix of the names. features no user can see are
+# left out
+def compile_feature_set(featureSetData):
+    compiled = []
+
+    features = featureSetData.get('features', {})
+    for featureName in features:
+        featureData = features[featureName]
+
+        if 'pctUsers' not in featureData:
+            continue
+
+        percent = min(max(int(featureData['pctUsers'] * 100), 0), 100)
+        if percent == 0:
+            continue
+
+        threshold = percent
+        if featureData['pctUsers'] == 1:
+            threshold |= COMPILED_ALL_USERS
+
+        if isinstance(featureName, unicode):
+            featureName = featureName.encode('utf-8')
+
+        compiled.append((-percent, -threshold, featureName))
+
+    compiled.sort()
+    thresholds = [-negThreshold for _, negThreshold, _ in compiled]
+    names = [name for _, _, name in compiled]
+
+    offsets = [0]
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+
+    return ''.join([
+        struct.pack('>3sBI', COMPILED_MAGIC, COMPILED_VERSION, len(names)),
+        struct.pack('>{}B'.format(len(thresholds)), *thresholds),
+        struct.pack('>{}I'.format(len(offsets)), *offsets),
+    ] + names)
+
+
+def snapshot_store():
+    global snapshotStore
+    if snapshotStore is None:
+        if SNAPSHOT_DIR != '':
+            snapshotStore = DirectorySnapshotStore(SNAPSHOT_DIR)
+        elif SNAPSHOT_BUCKET != '':
+            snapshotStore = S3SnapshotStore(SNAPSHOT_BUCKET)
+    return snapshotStore
+
+
+def error_code(e):
+    if 'Error' in e.response and 'Code' in e.response['Error']:
+        return e.response['Error']['Code']
+    return None
+
+
+def invalidate_sets_cache():
+    global setsCache
+    setsCache = None
+
+
+class CacheEntry(object):
+    __slots__ = ('value', 'etag', 'fetchedAt')
+
+    def __init__(self, value, etag, fetchedAt):
+        self.value = value
+        self.etag = etag
+        self.fetchedAt = fetchedAt
+
+
+setsCache = None
+
+
+class S3SnapshotStore(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.s3 = boto3.client('s3')
+
+    def put(self, key, body, cacheControl):
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=body,
+            ACL='public-read',
+            CacheControl=cacheControl,
+            ContentType='application/json'
+        )
+
+    def delete(self, key):
+        self.s3.delete_object(
+            Bucket=self.bucket,
+            Key=key
+        )
+
+
+# stands in for S3 when testing. keys are paths relative to the directory
+class DirectorySnapshotStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put(self, key, body, cacheControl):
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise e
+
+        # write then rename so readers never see a partial snapshot
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            f.write(body)
+        os.rename(tmpPath, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise e
+
+    def path(self, key):
+        root = os.path.abspath(self.directory)
+        path = os.path.abspath(os.path.join(root, key))
+        if not path.startswith(root + os.sep):
+            raise ValueError('snapshot key outside of directory: ' + key)
+        return path
+
+
+snapshotStore = None
+
+
+# collects what's logged about the current request
+class RequestLog(object):
+    def __init__(self, req, context):
+        self.start = time.time()
+        self.fields = {
+            'method': req.get('http_method'),
+            'path': req.get('resource_path')
+        }
+        if req.get('set_id'):
+            self.fields['setId'] = req['set_id']
+        if context is not None:
+            self.fields['requestId'] = getattr(context, 'aws_request_id', None)
+        # phase -> seconds
+        self.phases = {}
+        # counter -> count
+        self.counts = {}
+        self.consumedCapacity = 0.0
+        # table -> {'read': units, 'write': units}
+        self.tableCapacity = {}
+
+    def phase(self, name):
+        return PhaseTimer(self, name)
+
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    # sizes are summed when a request has several
+    def add_bytes(self, name, n):
+        self.fields[name] = self.fields.get(name, 0) + n
+
+    # ConsumedCapacity from a DynamoDB response. it's a list for batch calls.
+    # kind is 'read' or 'write'
+    def consumed(self, kind, consumedCapacity):
+        if isinstance(consumedCapacity, dict):
+            consumedCapacity = [consumedCapacity]
+        for capacity in consumedCapacity:
+            units = capacity.get('CapacityUnits', 0)
+            self.consumedCapacity += units
+            tableCapacity = self.tableCapacity.get(capacity.get('TableName'))
+            if tableCapacity is None:
+                tableCapacity = {'read': 0.0, 'write': 0.0}
+                self.tableCapacity[capacity.get('TableName')] = tableCapacity
+            tableCapacity[kind] += units
+
+    def emit(self, status):
+        if not REQUEST_LOG:
+            return
+
+        # emitted once per request, so the fields are reused for the line
+        line = self.fields
+        line['log'] = 'request'
+        line['status'] = int(status)
+        line['ms'] = round((time.time() - self.start) * 1000, 3)
+        phasesMs = {}
+        for name, seconds in self.phases.iteritems():
+            phasesMs[name] = round(seconds * 1000, 3)
+        line['phasesMs'] = phasesMs
+        line['counts'] = self.counts
+        line['consumedCapacity'] = self.consumedCapacity
+        print(logEncoder.encode(line))
+
+
+class PhaseTimer(object):
+    __slots__ = ('requestLog', 'name', 'start')
+
+    def __init__(self, requestLog, name):
+        self.requestLog = requestLog
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        self.requestLog.add_time(self.name, time.time() - self.start)
+
+
+# times every call to the wrapped boto3 client as the phase dynamodb.<operation>
+class TimedClient(object):
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        phase = 'dynamodb.' + name
+        kind = 'read'
+        if name in WRITE_OPERATIONS:
+            kind = 'write'
+
+        def call(**kwargs):
+            if CAPACITY_ACCOUNTING and kwargs.get('ReturnConsumedCapacity', 'NONE') == 'NONE':
+                kwargs['ReturnConsumedCapacity'] = 'TOTAL'
+
+            start = time.time()
+            try:
+                res = attr(**kwargs)
+            finally:
+                requestLog.add_time(phase, time.time() - start)
+                requestLog.count(phase)
+            if 'ConsumedCapacity' in res:
+                requestLog.consumed(kind, res['ConsumedCapacity'])
+            return res
+
+        # later lookups find it without going through __getattr__
+        setattr(self, name, call)
+        return call
+
+
+# consumed capacity summed per route ("GET /set/{set_id}/features"), feature
+# set and table since the last flush
+class CapacityAccount(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.invocations = 0
+        self.routes = {}
+        self.sets = {}
+        self.tables = {}
+
+    def record(self, requestLog):
+        self.invocations += 1
+
+        read = 0.0
+        write = 0.0
+        for tableName, tableCapacity in requestLog.tableCapacity.iteritems():
+            read += tableCapacity['read']
+            write += tableCapacity['write']
+            add_capacity(self.tables, tableName, tableCapacity['read'], tableCapacity['write'])
+
+        route = '{} {}'.format(requestLog.fields.get('method'), requestLog.fields.get('path'))
+        add_capacity(self.routes, route, read, write)
+        if 'setId' in requestLog.fields:
+            add_capacity(self.sets, requestLog.fields['setId'], read, write)
+
+        if self.invocations >= CAPACITY_FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        line = {
+            'log': 'capacity',
+            'invocations': self.invocations,
+            'seconds': round(time.time() - self.start, 3),
+            'routes': self.routes,
+            'sets': self.sets,
+            'tables': self.tables
+        }
+        print(json.dumps(line, sort_keys=True, separators=(',', ':')))
+        self.reset()
+
+
+def add_capacity(totals, key, read, write):
+    total = totals.get(key)
+    if total is None:
+        total = {'requests': 0, 'read': 0.0, 'write': 0.0}
+        totals[key] = total
+    total['requests'] += 1
+    total['read'] += read
+    total['write'] += write
+
+
+# requests handled outside of lambda_handler log nothing
+requestLog = RequestLog({}, None)
+capacityAccount = CapacityAccount()
+dynamodb = TimedClient(dynamodb)
+
 
 class HTTPError(Exception):
     def __init__(self, status_code):
         super(HTTPError, self).__init__(status_code)
+        self.status_code = status_code
 
 
 def s400():
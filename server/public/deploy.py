@@ -19,16 +19,31 @@ if accessControlAllowOrigin == "":
 
 requireAPIKey = os.environ['REQUIRE_API_KEY']
 
+# seconds API Gateway caches GET /set/{set_id}/shard/{shard}/features. 0 turns
+# off the stage's cache cluster
+apiCacheTTL = int(os.environ.get('API_CACHE_TTL') or '60')
+
 REQUEST_TEMPLATE = '''{
   "http_method": "$context.httpMethod",
   "resource_path": "$context.resourcePath",
+  "body": $input.json(\'$\'),
+  "headers": {
+    "if-none-match": "$util.escapeJavaScript($input.params().header.get('If-None-Match'))"
+  },
   "set_id": "$input.params('set_id')",
+  "shard": "$input.params('shard')",
+  "limit": "$input.params('limit')",
+  "cursor": "$input.params('cursor')",
+  "set_ids": "$input.params('set_ids')",
+  "since": "$input.params('since')",
   "user_id": "$input.params('user_id')"
 }'''
 
 FUNCTION_NAME = 'feature-flipper-public'
 
-httpStatuses = [200, 400, 404, 500]
+SHARD_FEATURES_PATH = '/set/{set_id}/shard/{shard}/features'
+
+httpStatuses = [200, 304, 400, 404, 500, 503]
 
 
 def deploy():
@@ -59,14 +74,46 @@ def ensure_api():
 
 
 def do_deployment(restApiId):
+    if apiCacheTTL <= 0:
+        apigateway.create_deployment(
+            restApiId=restApiId,
+            stageName='prod',
+            stageDescription='prod',
+            cacheClusterEnabled=False
+        )
+        print("created deployment")
+        return
+
     apigateway.create_deployment(
         restApiId=restApiId,
         stageName='prod',
         stageDescription='prod',
-        cacheClusterEnabled=False
+        cacheClusterEnabled=True,
+        cacheClusterSize='0.5'
     )
     print("created deployment")
 
+    # only the shard route is cached. its responses are keyed by set_id and
+    # shard (see create_route) so there are at most 100 entries per set
+    methodPath = SHARD_FEATURES_PATH.replace('/', '~1') + '/GET'
+    apigateway.update_stage(
+        restApiId=restApiId,
+        stageName='prod',
+        patchOperations=[
+            {
+                'op': 'replace',
+                'path': '/' + methodPath + '/caching/enabled',
+                'value': 'true'
+            },
+            {
+                'op': 'replace',
+                'path': '/' + methodPath + '/caching/ttlInSeconds',
+                'value': str(apiCacheTTL)
+            }
+        ]
+    )
+    print("caching", SHARD_FEATURES_PATH, "for", apiCacheTTL, "seconds")
+
 
 def ensure_resources(restApiId):
     resourcesResp = apigateway.get_resources(restApiId=restApiId)
@@ -86,20 +133,36 @@ def ensure_resources(restApiId):
             except Exception:
                 pass
 
-    create_route(restApiId, rootId, "sets", ["GET"])
+    setsId = create_route(restApiId, rootId, "sets", ["GET"])
+    create_route(restApiId, setsId, "features", ["GET"])
+
+    create_route(restApiId, rootId, "aliases", ["GET"])
+    create_route(restApiId, rootId, "changes", ["GET"])
 
     setId = create_route(restApiId, rootId, "set", [])
     setSetId = create_route(restApiId, setId, ":set_id", [])
 
     create_route(restApiId, setSetId, "aliases", ["GET"])
-    create_route(restApiId, setSetId, "features", ["GET"])
+    create_route(restApiId, setSetId, "features", ["GET", "POST"])
+    create_route(restApiId, setSetId, "pct_users", ["GET"])
+    create_route(restApiId, setSetId, "watch", ["GET"])
+
+    shardId = create_route(restApiId, setSetId, "shard", [])
+    shardShardId = create_route(restApiId, shardId, ":shard", [])
+    create_route(restApiId, shardShardId, "features", ["GET"], ["set_id", "shard"])
 
 
-def create_route(restApiId, parentId, path, httpMethods):
+# cacheKeys are path parameters API Gateway caches the route's responses by
+def create_route(restApiId, parentId, path, httpMethods, cacheKeys=[]):
     time.sleep(1)
     print("creating route", path, httpMethods)
 
     requestParameters = {
+        "method.request.header.If-None-Match": False,
+        "method.request.querystring.cursor": False,
+        "method.request.querystring.limit": False,
+        "method.request.querystring.set_ids": False,
+        "method.request.querystring.since": False,
         "method.request.querystring.user_id": False
     }
 
@@ -109,6 +172,11 @@ def create_route(restApiId, parentId, path, httpMethods):
     else:
         pathPart = path
 
+    cacheKeyParameters = []
+    for cacheKey in cacheKeys:
+        requestParameters['method.request.path.' + cacheKey] = True
+        cacheKeyParameters.append('method.request.path.' + cacheKey)
+
     print(
         'create_resource',
         'restApiId', restApiId,
@@ -158,7 +226,8 @@ def create_route(restApiId, parentId, path, httpMethods):
             uri=functionIntegrationURI,
             requestTemplates={
                 'application/json': REQUEST_TEMPLATE
-            }
+            },
+            cacheKeyParameters=cacheKeyParameters
         )
 
         # enable throwing exceptions with status codes to actually return the
@@ -176,12 +245,24 @@ def create_route(restApiId, parentId, path, httpMethods):
             else:
                 selectionPattern = statusCode
 
+            methodRespParameters = {
+                'method.response.header.ETag': False
+            }
+            corsMethodResponseParameters(methodRespParameters)
+
+            integrationRespParameters = {
+                # https://forums.aws.amazon.com/thread.jspa?threadID=203889
+                # TODO change this this once lambda responses can include headers
+                'method.response.header.ETag': 'integration.response.body.ETag'
+            }
+            corsIntegrationResponseParameters(integrationRespParameters)
+
             apigateway.put_method_response(
                 restApiId=restApiId,
                 resourceId=resourceId,
                 httpMethod=httpMethod,
                 statusCode=statusCode,
-                responseParameters=corsMethodResponseParameters({})
+                responseParameters=methodRespParameters
             )
 
             apigateway.put_integration_response(
@@ -190,7 +271,7 @@ def create_route(restApiId, parentId, path, httpMethods):
                 httpMethod=httpMethod,
                 statusCode=statusCode,
                 selectionPattern=selectionPattern,
-                responseParameters=corsIntegrationResponseParameters({})
+                responseParameters=integrationRespParameters
             )
 
     return resource['id']
@@ -251,13 +332,15 @@ def corsMethodResponseParameters(responseParameters):
     responseParameters['method.response.header.Access-Control-Allow-Headers'] = False
     responseParameters['method.response.header.Access-Control-Allow-Methods'] = False
     responseParameters['method.response.header.Access-Control-Allow-Origin'] = False
+    responseParameters['method.response.header.Access-Control-Expose-Headers'] = False
     return responseParameters
 
 
 def corsIntegrationResponseParameters(responseParameters):
-    responseParameters['method.response.header.Access-Control-Allow-Headers'] = "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,If-Match'"
-    responseParameters['method.response.header.Access-Control-Allow-Methods'] = "'GET,OPTIONS'"
+    responseParameters['method.response.header.Access-Control-Allow-Headers'] = "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,If-Match,If-None-Match'"
+    responseParameters['method.response.header.Access-Control-Allow-Methods'] = "'GET,POST,OPTIONS'"
     responseParameters['method.response.header.Access-Control-Allow-Origin'] = "'{}'".format(accessControlAllowOrigin)
+    responseParameters['method.response.header.Access-Control-Expose-Headers'] = "'ETag'"
     return responseParameters
 
 
@@ -10,27 +10,161 @@
 from __future__ import print_function
 
 import boto3
+import botocore
+import errno
 import hashlib
+import json
 import msgpack
+import os
+import random
+import struct
+import time
 import traceback
+import urllib
+import zlib
+
+from collections import OrderedDict
 
 print('Loading function')
 
-dynamodb = boto3.client('dynamodb')
+# throttled calls, DynamoDB server errors and connection errors are retried by
+# TimedClient rather than the SDK so the retries are budgeted and logged
+dynamodb = boto3.client('dynamodb', config=botocore.config.Config(retries={'max_attempts': 0}))
 
 DB_DATA_TABLE = 'FeatureFlipper'
 DB_ALIAS_TABLE = 'FeatureFlipperAliases'
+# global secondary index on FeatureSet, created by server/deploy.py
+DB_ALIAS_SET_INDEX = 'FeatureSet-index'
+DB_CHANGES_TABLE = 'FeatureFlipperChanges'
+
+# partition of DB_CHANGES_TABLE the private API appends every write to
+CHANGE_FEED = 'changes'
+
+# key of the item in DB_DATA_TABLE that lists every set and its ETag. it can't
+# collide with a set name since those must match the channelSet regex in the
+# private API
+SET_INDEX_KEY = '.index'
+
+# warm containers keep decoded feature sets and alias resolutions around between
+# invocations. once an entry is older than its TTL the set's ETag is checked
+# before the (much larger) Data attribute is read again
+FEATURE_SET_CACHE_TTL = float(os.environ.get('FEATURE_SET_CACHE_TTL', '30'))
+FEATURE_SET_CACHE_SIZE = int(os.environ.get('FEATURE_SET_CACHE_SIZE', '256'))
+ALIAS_CACHE_TTL = float(os.environ.get('ALIAS_CACHE_TTL', '300'))
+ALIAS_CACHE_SIZE = int(os.environ.get('ALIAS_CACHE_SIZE', '1024'))
+
+# max user ids accepted by POST /set/{set_id}/features
+BATCH_MAX_USERS = int(os.environ.get('BATCH_MAX_USERS', '10000'))
+
+# GET /sets walks every page of the table unless a limit is given. the full
+# listing is cached for SETS_CACHE_TTL seconds
+SETS_CACHE_TTL = float(os.environ.get('SETS_CACHE_TTL', '60'))
+SETS_MAX_LIMIT = 1000
+
+# the full alias -> set map served by GET /aliases is cached this many seconds
+ALIASES_CACHE_TTL = float(os.environ.get('ALIASES_CACHE_TTL', '300'))
+
+# GET /set/{set_id}/watch holds the request open this many seconds waiting for
+# the set to change, checking its ETag every WATCH_POLL_INTERVAL seconds. API
+# Gateway gives up on integrations after 29 seconds. every check is a GetItem
+# and a watch holds a concurrent execution for the whole time
+WATCH_TIMEOUT = min(float(os.environ.get('WATCH_TIMEOUT', '20')), 25)
+WATCH_POLL_INTERVAL = float(os.environ.get('WATCH_POLL_INTERVAL', '5'))
+
+# GET /changes returns at most this many changes per call. sequence numbers are
+# taken before a change is written so a later change can show up before an
+# earlier one. a gap in the feed is only skipped once the change after it is
+# CHANGES_SETTLE_SECONDS old
+CHANGES_MAX_LIMIT = 1000
+CHANGES_DEFAULT_LIMIT = 100
+CHANGES_SETTLE_SECONDS = float(os.environ.get('CHANGES_SETTLE_SECONDS', '10'))
+
+# marks zlib compressed Data. see encode_data in the private Lambda
+DATA_ZLIB_MARKER = '\xc1'
+
+# feature sets are evaluated from the Compiled attribute so that's all that's
+# read. Data, which holds the descriptions too, is only read for sets last
+# written before Compiled existed and for GET /set/{set_id}/pct_users
+EVALUATION_ATTRIBUTES = ['ETag', 'Compiled']
+
+# see compile_feature_set in the private Lambda
+COMPILED_MAGIC = 'FFC'
+COMPILED_VERSION = 1
+COMPILED_ALL_USERS = 0x80
+COMPILED_PERCENT_MASK = 0x7f
+
+# one JSON line is logged per request with the time spent in each phase,
+# DynamoDB calls and consumed capacity, cache hits and misses, and the size of
+# the feature set responses served. REQUEST_LOG=0 turns it off
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') != '0'
+# made once rather than by json.dumps for every line. sort_keys would make it
+# use json's pure python encoder
+logEncoder = json.JSONEncoder(separators=(',', ':'))
+
+# CAPACITY_ACCOUNTING=1 asks DynamoDB for the capacity every call consumes and
+# sums it per route, feature set and table across the invocations of the
+# container. the sums are logged as one JSON line every CAPACITY_FLUSH_EVERY
+# invocations
+CAPACITY_ACCOUNTING = os.environ.get('CAPACITY_ACCOUNTING', '0') == '1'
+CAPACITY_FLUSH_EVERY = int(os.environ.get('CAPACITY_FLUSH_EVERY', '100'))
+WRITE_OPERATIONS = ['put_item', 'update_item', 'delete_item']
+
+# throttled DynamoDB calls, calls DynamoDB failed with a server error, and
+# BatchGetItem keys left unprocessed, are retried up to THROTTLE_RETRIES times
+# after a random sleep of up to THROTTLE_BACKOFF_BASE * 2^(retry - 1) seconds,
+# capped at THROTTLE_BACKOFF_MAX. each retry takes a token from a bucket of
+# RETRY_BUCKET_SIZE tokens that refills at RETRY_BUCKET_RATE tokens a second.
+# while it's empty nothing is retried and cached sets past their TTL are served
+# as they are instead of being read again, so a container doesn't add to the
+# throttling. a read that still fails, or can't reach DynamoDB at all, is
+# answered from the cache when it can be and with a 503 when it can't.
+# responses served from the cache this way include "stale": true
+THROTTLE_RETRIES = int(os.environ.get('THROTTLE_RETRIES', '3'))
+THROTTLE_BACKOFF_BASE = float(os.environ.get('THROTTLE_BACKOFF_BASE', '0.025'))
+THROTTLE_BACKOFF_MAX = float(os.environ.get('THROTTLE_BACKOFF_MAX', '0.5'))
+RETRY_BUCKET_SIZE = float(os.environ.get('RETRY_BUCKET_SIZE', '10'))
+RETRY_BUCKET_RATE = float(os.environ.get('RETRY_BUCKET_RATE', '1'))
+THROTTLING_ERRORS = ['ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded']
+SERVER_ERRORS = ['InternalServerError', 'ServiceUnavailable']
+
+# sets read from DynamoDB are also written to DISK_CACHE_DIR, along with the
+# aliases that point to them, so they outlive the in-memory caches: a set
+# evicted from memory, or a runtime restarted in the same container, starts
+# from the copy on disk. a copy is only read when the set isn't in memory and
+# counts as expired, so its ETag is checked before it's served unless DynamoDB
+# can't be reached. only sets with a Compiled attribute are written. '' turns
+# it off
+DISK_CACHE_DIR = os.environ.get('DISK_CACHE_DIR', '/tmp/feature-flipper')
+
+# BatchGetItem accepts at most 100 keys per request
+BATCH_GET_MAX_KEYS = 100
 
 
 def lambda_handler(req, context):
+    global requestLog
+    requestLog = RequestLog(req, context)
+    status = '200'
     try:
-        return handle_request(req)
+        res = handle_request(req)
+        if 'stale' in requestLog.fields and isinstance(res, dict):
+            res = dict(res, stale=True)
+        return res
     except HTTPError, e:
+        status = e.status_code
         traceback.print_exc()
         raise e
+    except Unavailable, e:
+        status = '503'
+        traceback.print_exc()
+        s503()
     except Exception, e:
+        status = '500'
         traceback.print_exc()
         s500()
+    finally:
+        requestLog.emit(status)
+        if CAPACITY_ACCOUNTING:
+            capacityAccount.record(requestLog)
 
 
 def handle_request(req):
@@ -41,102 +175,373 @@ def handle_request(req):
     if 'resource_path' not in req:
         s400()
 
-    print(req['http_method'] + ' ' + req['resource_path'])
     if req['http_method'] == "GET":
 
         if req['resource_path'] == "/sets":
             return get_feature_sets(req)
 
+        elif req['resource_path'] == "/sets/features":
+            return get_features_for_sets(req)
+
         elif req['resource_path'] == "/set/{set_id}/features":
             if 'user_id' in req and req['user_id'] != "":
                 return get_features_for_user(req)
             else:
                 return get_features(req)
 
+        elif req['resource_path'] == "/set/{set_id}/pct_users":
+            return get_pct_users(req)
+
+        elif req['resource_path'] == "/set/{set_id}/shard/{shard}/features":
+            return get_features_for_shard(req)
+
+        elif req['resource_path'] == "/set/{set_id}/watch":
+            return watch_features(req)
+
         elif req['resource_path'] == "/set/{set_id}/aliases":
             return get_set_aliases(req)
 
+        elif req['resource_path'] == "/aliases":
+            return get_aliases(req)
+
+        elif req['resource_path'] == "/changes":
+            return get_changes(req)
+
+    elif req['http_method'] == "POST":
+
+        if req['resource_path'] == "/set/{set_id}/features":
+            return get_features_for_users(req)
+
     s404()
 
 
 def get_feature_sets(req):
-    scanRes = dynamodb.scan(
+    limit = request_limit(req)
+    if limit is None:
+        featureSets, versions = list_feature_sets()
+        return {'featureSets': featureSets, 'versions': versions}
+
+    cursor = None
+    if 'cursor' in req and req['cursor'] != "":
+        cursor = req['cursor']
+
+    featureSets, versions, cursor = get_feature_sets_page(limit, cursor)
+    res = {'featureSets': featureSets, 'versions': versions}
+    if cursor is not None:
+        res['cursor'] = cursor
+    return res
+
+
+def request_limit(req):
+    if 'limit' not in req or req['limit'] == "":
+        return None
+
+    try:
+        limit = int(req['limit'])
+    except ValueError:
+        s400()
+
+    if limit < 1 or limit > SETS_MAX_LIMIT:
+        s400()
+
+    return limit
+
+
+# every set name and its ETag. the listing is cached in the container for
+# SETS_CACHE_TTL seconds
+def list_feature_sets():
+    global setsCache
+
+    now = time.time()
+    if setsCache is not None and now - setsCache.fetchedAt < SETS_CACHE_TTL:
+        return setsCache.value
+
+    if shed_read(setsCache, SETS_CACHE_TTL):
+        return setsCache.value
+
+    try:
+        versions = read_feature_set_versions()
+    except Unavailable, e:
+        if setsCache is None:
+            raise
+        served_stale(e)
+        return setsCache.value
+
+    setsCache = CacheEntry((sorted(versions), versions), None, now)
+    return setsCache.value
+
+
+def read_feature_set_versions():
+    versions = get_set_index()
+    if versions is None:
+        versions = {}
+        cursor = None
+        while True:
+            pageVersions, cursor = scan_feature_sets(None, cursor)
+            versions.update(pageVersions)
+            if cursor is None:
+                break
+    return versions
+
+
+# one page of set names, their ETags and the cursor for the next page, which is
+# None on the last page
+def get_feature_sets_page(limit, cursor):
+    versions = get_set_index()
+    if versions is None:
+        versions, cursor = scan_feature_sets(limit, cursor)
+        return sorted(versions), versions, cursor
+
+    featureSets = sorted(versions)
+    if cursor is not None:
+        featureSets = [featureSet for featureSet in featureSets if featureSet > cursor]
+
+    cursor = None
+    if len(featureSets) > limit:
+        featureSets = featureSets[:limit]
+        cursor = featureSets[-1]
+
+    pageVersions = {}
+    for featureSet in featureSets:
+        pageVersions[featureSet] = versions[featureSet]
+
+    return featureSets, pageVersions, cursor
+
+
+# the set index item maintained by the private API's write paths. returns a
+# dict of set name to ETag or None if the index hasn't been built yet
+def get_set_index():
+    getIndexRes = dynamodb.get_item(
         TableName=DB_DATA_TABLE,
-        Select='SPECIFIC_ATTRIBUTES',
-        ReturnConsumedCapacity='NONE',
-        ProjectionExpression='FeatureSet',
-        ConsistentRead=False
+        Key={
+            'FeatureSet': {
+                'S': SET_INDEX_KEY
+            }
+        },
+        ConsistentRead=False,
+        ReturnConsumedCapacity='NONE'
     )
 
+    if 'Item' not in getIndexRes:
+        return None
+
+    item = getIndexRes['Item']
+    if 'Sets' not in item or 'M' not in item['Sets']:
+        return None
+
+    versions = {}
+    for featureSet, etag in item['Sets']['M'].iteritems():
+        versions[featureSet] = etag.get('N', '')
+
+    return versions
+
+
+# a page of the table scan used while there's no set index. returns a dict of
+# set name to ETag and the cursor for the next page
+def scan_feature_sets(limit, cursor):
+    scanArgs = {
+        'TableName': DB_DATA_TABLE,
+        'Select': 'SPECIFIC_ATTRIBUTES',
+        'ReturnConsumedCapacity': 'NONE',
+        'ProjectionExpression': 'FeatureSet, #etag',
+        'ExpressionAttributeNames': {
+            '#etag': 'ETag'
+        },
+        'ConsistentRead': False
+    }
+
+    if limit is not None:
+        scanArgs['Limit'] = limit
+
+    if cursor is not None:
+        scanArgs['ExclusiveStartKey'] = {
+            'FeatureSet': {
+                'S': cursor
+            }
+        }
+
+    scanRes = dynamodb.scan(**scanArgs)
+
     if 'Items' not in scanRes:
         s404()
 
-    featureSets = []
+    versions = {}
     for item in scanRes['Items']:
         if 'FeatureSet' in item and 'S' in item['FeatureSet']:
-            featureSets.append(item['FeatureSet']['S'])
+            if item['FeatureSet']['S'] == SET_INDEX_KEY:
+                continue
+            if 'ETag' in item and 'N' in item['ETag']:
+                versions[item['FeatureSet']['S']] = item['ETag']['N']
+            else:
+                versions[item['FeatureSet']['S']] = ''
 
-    return {'featureSets': featureSets}
+    cursor = None
+    if 'LastEvaluatedKey' in scanRes:
+        cursor = scanRes['LastEvaluatedKey']['FeatureSet']['S']
+
+    return versions, cursor
 
 
 def get_set_aliases(req):
     if 'set_id' not in req:
         s400()
 
-    scanRes = dynamodb.scan(
-        TableName=DB_ALIAS_TABLE,
-        Select='SPECIFIC_ATTRIBUTES',
-        ReturnConsumedCapacity='NONE',
-        ProjectionExpression='Alias',
-        FilterExpression='#fs = :fs',
-        ExpressionAttributeNames={
+    return {'aliases': query_set_aliases(req['set_id'])}
+
+
+# every alias of setId via the FeatureSet index on the alias table, so the cost
+# follows the number of aliases of this set rather than all aliases
+def query_set_aliases(setId):
+    queryArgs = {
+        'TableName': DB_ALIAS_TABLE,
+        'IndexName': DB_ALIAS_SET_INDEX,
+        'Select': 'SPECIFIC_ATTRIBUTES',
+        'ReturnConsumedCapacity': 'NONE',
+        'ProjectionExpression': 'Alias',
+        'KeyConditionExpression': '#fs = :fs',
+        'ExpressionAttributeNames': {
             '#fs': 'FeatureSet'
         },
-        ExpressionAttributeValues={
+        'ExpressionAttributeValues': {
             ':fs': {
-                'S': req['set_id']
+                'S': setId
             }
-        },
-        ConsistentRead=False
-    )
-
-    if 'Items' not in scanRes:
-        s404()
+        }
+    }
 
     aliases = []
-    for item in scanRes['Items']:
+    while True:
+        queryRes = dynamodb.query(**queryArgs)
+
+        for item in queryRes.get('Items', []):
+            if 'Alias' in item and 'S' in item['Alias']:
+                aliases.append(item['Alias']['S'])
+
+        if 'LastEvaluatedKey' not in queryRes:
+            return aliases
+
+        queryArgs['ExclusiveStartKey'] = queryRes['LastEvaluatedKey']
+
+
+# the alias -> set map for every alias. callers that send back the ETag of the
+# map they have in If-None-Match get a 304 if it hasn't changed
+def get_aliases(req):
+    limit = request_limit(req)
+    if limit is None:
+        aliases, etag = list_aliases()
+        if if_none_match(req) == etag:
+            s304()
+        return {'aliases': aliases, 'ETag': etag}
+
+    cursor = None
+    if 'cursor' in req and req['cursor'] != "":
+        cursor = req['cursor']
+
+    aliases, cursor = scan_aliases(limit, cursor)
+    res = {'aliases': aliases}
+    if cursor is not None:
+        res['cursor'] = cursor
+    return res
+
+
+# every alias and the set it points to along with a version of the map. cached
+# in the container for ALIASES_CACHE_TTL seconds
+def list_aliases():
+    global aliasesCache
+
+    now = time.time()
+    if aliasesCache is not None and now - aliasesCache.fetchedAt < ALIASES_CACHE_TTL:
+        return aliasesCache.value, aliasesCache.etag
+
+    aliases = {}
+    cursor = None
+    while True:
+        pageAliases, cursor = scan_aliases(None, cursor)
+        aliases.update(pageAliases)
+        if cursor is None:
+            break
+
+    etag = hashlib.md5(json.dumps(aliases, sort_keys=True)).hexdigest()
+    aliasesCache = CacheEntry(aliases, etag, now)
+    return aliases, etag
+
+
+# a page of the alias table as a dict of alias to set and the cursor for the
+# next page, which is None on the last page
+def scan_aliases(limit, cursor):
+    scanArgs = {
+        'TableName': DB_ALIAS_TABLE,
+        'Select': 'SPECIFIC_ATTRIBUTES',
+        'ReturnConsumedCapacity': 'NONE',
+        'ProjectionExpression': 'Alias, FeatureSet',
+        'ConsistentRead': False
+    }
+
+    if limit is not None:
+        scanArgs['Limit'] = limit
+
+    if cursor is not None:
+        scanArgs['ExclusiveStartKey'] = {
+            'Alias': {
+                'S': cursor
+            }
+        }
+
+    scanRes = dynamodb.scan(**scanArgs)
+
+    aliases = {}
+    for item in scanRes.get('Items', []):
         if 'Alias' in item and 'S' in item['Alias']:
-            aliases.append(item['Alias']['S'])
+            aliases[item['Alias']['S']] = alias_item_set_id(item['Alias']['S'], item)
+
+    cursor = None
+    if 'LastEvaluatedKey' in scanRes:
+        cursor = scanRes['LastEvaluatedKey']['Alias']['S']
+
+    return aliases, cursor
+
+
+# the If-None-Match request header without quotes or a weak validator prefix
+def if_none_match(req):
+    if 'headers' not in req or not isinstance(req['headers'], dict):
+        return None
+
+    etag = req['headers'].get('if-none-match')
+    if etag is None or etag == "":
+        return None
 
-    return {'aliases': aliases}
+    if etag.startswith('W/'):
+        etag = etag[2:]
+
+    return etag.strip('"')
 
 
 def get_features(req):
     if 'set_id' not in req:
         s400()
 
-    setId = req['set_id']
-    featureSetData = get_feature_set_data(setId)
-    if featureSetData is None:
-        s404()
+    check_not_modified(req)
 
-    if 'features' not in featureSetData:
-        return {'features': []}
+    featureSet = get_feature_set(req['set_id'])
+    if featureSet is None:
+        s404()
 
-    features = []
+    return features_response(featureSet, None)
 
-    for featureName in featureSetData['features']:
-        featureData = featureSetData['features'][featureName]
 
-        if 'pctUsers' not in featureData:
-            continue
+# pctUsers of every feature that has one, for clients that evaluate users
+# themselves. supports If-None-Match like get_features
+def get_pct_users(req):
+    if 'set_id' not in req:
+        s400()
 
-        if featureData['pctUsers'] != 1:
-            continue
+    check_not_modified(req)
 
-        features.append(featureName)
+    featureSet = get_feature_set(req['set_id'])
+    if featureSet is None:
+        s404()
 
-    return {'features': features}
+    return featureSet.pctUsersResponse
 
 
 def get_features_for_user(req):
@@ -146,35 +551,645 @@ def get_features_for_user(req):
     if 'user_id' not in req:
         s400()
 
-    featureSetData = get_feature_set_data(req['set_id'])
-    if featureSetData is None:
+    check_not_modified(req)
+
+    featureSet = get_feature_set(req['set_id'])
+    if featureSet is None:
         s404()
 
-    if 'features' not in featureSetData:
-        return {'features': []}
+    return features_response(featureSet, user_shard(req['user_id']))
+
+
+# the same response as get_features_for_user for every user in the shard, so
+# API Gateway can cache it by set_id and shard. If-None-Match is ignored since
+# it isn't part of the cache key
+def get_features_for_shard(req):
+    if 'set_id' not in req:
+        s400()
+
+    if 'shard' not in req:
+        s400()
+
+    try:
+        shard = int(req['shard'])
+    except ValueError:
+        s400()
+
+    if shard < 0 or shard >= 100:
+        s400()
+
+    featureSet = get_feature_set(req['set_id'])
+    if featureSet is None:
+        s404()
+
+    return features_response(featureSet, shard)
+
+
+# long poll for changes to a set. responds as soon as the set's ETag is greater
+# than since, or 304 if that doesn't happen within WATCH_TIMEOUT. the response
+# is the same as GET /set/{set_id}/features
+def watch_features(req):
+    if 'set_id' not in req:
+        s400()
+
+    if req['set_id'] == SET_INDEX_KEY:
+        s404()
+
+    since = None
+    if 'since' in req and req['since'] != "":
+        try:
+            since = int(req['since'])
+        except ValueError:
+            s400()
+
+    shard = None
+    if 'user_id' in req and req['user_id'] != "":
+        shard = user_shard(req['user_id'])
+
+    setId = resolve_alias(req['set_id'])
+
+    if since is None:
+        featureSet = get_real_feature_set(setId, time.time())
+        if featureSet is None:
+            s404()
+        return features_response(featureSet, shard)
+
+    deadline = time.time() + WATCH_TIMEOUT
+    while True:
+        # the cached copy may be up to FEATURE_SET_CACHE_TTL old so the ETag is
+        # always read from the table
+        etag = get_feature_set_etag(setId)
+        if etag is None:
+            s404()
+
+        if etag_number(etag) > since:
+            featureSet = load_feature_set(setId, time.time())
+
+            # an eventually consistent read of the data can lag the ETag read.
+            # keep waiting in that case
+            if featureSet is not None and etag_number(featureSet.etag) > since:
+                return features_response(featureSet, shard)
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            s304()
+
+        with requestLog.phase('wait'):
+            time.sleep(min(WATCH_POLL_INTERVAL, remaining))
+
+
+# changes after the sequence number in since, oldest first. callers pass the
+# returned sequence back as since on their next call
+def get_changes(req):
+    since = 0
+    if 'since' in req and req['since'] != "":
+        try:
+            since = int(req['since'])
+        except ValueError:
+            s400()
+
+    if since < 0:
+        s400()
+
+    limit = CHANGES_DEFAULT_LIMIT
+    if 'limit' in req and req['limit'] != "":
+        try:
+            limit = int(req['limit'])
+        except ValueError:
+            s400()
+
+        if limit < 1 or limit > CHANGES_MAX_LIMIT:
+            s400()
+
+    changes, more = query_changes(since, limit)
+
+    sequence = since
+    if len(changes) > 0:
+        sequence = changes[-1]['sequence']
+
+    return {'changes': changes, 'sequence': sequence, 'more': more}
+
+
+def query_changes(since, limit):
+    queryArgs = {
+        'TableName': DB_CHANGES_TABLE,
+        'ConsistentRead': True,
+        'ReturnConsumedCapacity': 'NONE',
+        'KeyConditionExpression': '#feed = :feed AND #seq > :since',
+        'ExpressionAttributeNames': {
+            '#feed': 'Feed',
+            '#seq': 'Sequence'
+        },
+        'ExpressionAttributeValues': {
+            ':feed': {
+                'S': CHANGE_FEED
+            },
+            ':since': {
+                'N': str(since)
+            }
+        },
+        'Limit': limit + 1
+    }
+
+    settled = time.time() - CHANGES_SETTLE_SECONDS
+    changes = []
+    expected = since + 1
+    while True:
+        queryRes = dynamodb.query(**queryArgs)
+
+        for item in queryRes.get('Items', []):
+            change = change_from_item(item)
+
+            # a missing sequence number is either a write still in flight or
+            # one that failed. stop in front of it until it has settled
+            if change['sequence'] != expected and change['createdAt'] > settled:
+                return changes, True
+
+            if len(changes) == limit:
+                return changes, True
+
+            changes.append(change)
+            expected = change['sequence'] + 1
+
+        if 'LastEvaluatedKey' not in queryRes:
+            return changes, False
+
+        queryArgs['ExclusiveStartKey'] = queryRes['LastEvaluatedKey']
+
+
+def change_from_item(item):
+    change = {
+        'sequence': int(item['Sequence']['N']),
+        'type': item['Type']['S'],
+        'id': item['Id']['S'],
+        'op': item['Op']['S'],
+        'createdAt': int(item['CreatedAt']['N'])
+    }
+
+    if 'FeatureSet' in item and 'S' in item['FeatureSet']:
+        change['featureSet'] = item['FeatureSet']['S']
+
+    if 'ETag' in item and 'S' in item['ETag']:
+        change['ETag'] = item['ETag']['S']
+
+    return change
+
+
+def features_response(featureSet, shard):
+    if REQUEST_LOG:
+        requestLog.add_bytes('responseBytes', featureSet.response_bytes(shard))
+    if shard is None:
+        return featureSet.allUsersResponse
+    return featureSet.response_for_shard(shard)
+
+
+def etag_number(etag):
+    if etag == '':
+        return 0
+    return int(etag)
+
+
+# responses for a set only change with its ETag so a caller that already has
+# the current ETag gets a 304. only the ETag attribute is read to decide that
+def check_not_modified(req):
+    ifNoneMatch = if_none_match(req)
+    if ifNoneMatch is None:
+        return
+
+    etag = get_feature_set_version(req['set_id'])
+    if etag is not None and etag == ifNoneMatch:
+        s304()
+
+
+# the current ETag of setId (or the set it aliases) or None if the set doesn't
+# exist. a cached copy of the set is kept fresh when its ETag hasn't moved and
+# dropped when it has
+def get_feature_set_version(setId):
+    if setId == SET_INDEX_KEY:
+        return None
+
+    stale = cached_feature_set_entry(setId)
+    if shed_read(stale, FEATURE_SET_CACHE_TTL):
+        return stale.etag
+
+    try:
+        return read_feature_set_version(setId)
+    except Unavailable, e:
+        if stale is None:
+            raise
+        served_stale(e)
+        return stale.etag
+
+
+def read_feature_set_version(setId):
+    setId = resolve_alias(setId)
+
+    now = time.time()
+    entry = featureSetCache.get(setId)
+    if entry is not None and now - entry.fetchedAt < FEATURE_SET_CACHE_TTL:
+        return entry.etag
+
+    etag = get_feature_set_etag(setId)
+    if entry is not None:
+        if etag == entry.etag:
+            entry.fetchedAt = now
+        else:
+            featureSetCache.remove(setId)
+
+    return etag
+
+
+# evaluates many users against one set. the set is loaded once and each user
+# costs a hash and a shard table lookup
+#
+# request body
+# {
+#   "user_ids": ["me", "me2"]
+# }
+def get_features_for_users(req):
+    if 'set_id' not in req:
+        s400()
+
+    if 'body' not in req or not isinstance(req['body'], dict):
+        s400()
+
+    userIds = req['body'].get('user_ids')
+    if not isinstance(userIds, list) or len(userIds) > BATCH_MAX_USERS:
+        s400()
+
+    for userId in userIds:
+        if not isinstance(userId, basestring):
+            s400()
+
+    featureSet = get_feature_set(req['set_id'])
+    if featureSet is None:
+        s404()
+
+    featuresForShard = featureSet.features_for_shard
+    users = {}
+    with requestLog.phase('evaluate'):
+        for userId, shard in zip(userIds, user_shards(userIds)):
+            users[userId] = featuresForShard(shard)
+
+    return {'users': users}
+
+
+# resolves several sets (or aliases) in one call. aliases are read with one
+# BatchGetItem and the feature data with another so latency doesn't grow with
+# the number of sets
+def get_features_for_sets(req):
+    if 'set_ids' not in req:
+        s400()
+
+    setIds = []
+    for setId in req['set_ids'].split(','):
+        if setId != '' and setId not in setIds:
+            setIds.append(setId)
+
+    if len(setIds) == 0 or len(setIds) > BATCH_GET_MAX_KEYS:
+        s400()
+
+    # the set index isn't a feature set. like a set that doesn't exist it's
+    # left out of the response, without reading it
+    if SET_INDEX_KEY in setIds:
+        setIds.remove(SET_INDEX_KEY)
+        if len(setIds) == 0:
+            return {'featureSets': {}}
+
+    shard = None
+    if 'user_id' in req and req['user_id'] != "":
+        shard = user_shard(req['user_id'])
+
+    featureSets = {}
+    for setId, featureSet in get_feature_set_batch(setIds).iteritems():
+        featureSets[setId] = features_response(featureSet, shard)
+
+    return {'featureSets': featureSets}
+
+
+# clients that call GET /set/{set_id}/shard/{shard}/features must compute the
+# same shard. see docs/client-api.md. user ids are hashed as UTF-8
+def user_shard(userId):
+    if isinstance(userId, unicode):
+        userId = userId.encode('utf-8')
+    return int(hashlib.md5(userId).hexdigest(), 16) % 100
+
+
+def user_shards(userIds):
+    md5 = hashlib.md5
+    try:
+        # md5 encodes unicode as ascii, which is the same bytes as UTF-8 for
+        # the ids it accepts
+        return [int(md5(userId).hexdigest(), 16) % 100 for userId in userIds]
+    except UnicodeEncodeError:
+        return [user_shard(userId) for userId in userIds]
+
+
+# returns the CompiledFeatureSet for setId (or the set it aliases) or None if
+# the set doesn't exist
+def get_feature_set(setId):
+    if setId == SET_INDEX_KEY:
+        return None
+
+    stale = cached_feature_set_entry(setId)
+    if shed_read(stale, FEATURE_SET_CACHE_TTL):
+        return stale.value
 
-    shard = int(hashlib.md5(req['user_id']).hexdigest(), 16) % 100
-    features = []
+    try:
+        return read_feature_set(setId)
+    except Unavailable, e:
+        if stale is None:
+            raise
+        served_stale(e)
+        return stale.value
+
+
+def read_feature_set(setId):
+    now = time.time()
+
+    aliasEntry = aliasCache.get(setId)
+    if aliasEntry is not None and now - aliasEntry.fetchedAt < ALIAS_CACHE_TTL:
+        return get_real_feature_set(aliasEntry.value, now)
+
+    entry = featureSetCache.get(setId)
+    if entry is not None and now - entry.fetchedAt < FEATURE_SET_CACHE_TTL:
+        return get_real_feature_set(resolve_alias(setId), now)
+
+    # setId is far more often a set name than an alias so the alias and the
+    # set are read together. the set only has to be read again if setId turns
+    # out to be an alias. when an expired copy of the set is cached only its
+    # ETag is read
+    dataKeysAndAttributes = {
+        'Keys': [{'FeatureSet': {'S': setId}}],
+        'ConsistentRead': False
+    }
+    if entry is not None:
+        dataKeysAndAttributes['ProjectionExpression'] = '#etag'
+        dataKeysAndAttributes['ExpressionAttributeNames'] = {'#etag': 'ETag'}
+    else:
+        dataKeysAndAttributes['ProjectionExpression'] = '#etag, #compiled'
+        dataKeysAndAttributes['ExpressionAttributeNames'] = {'#etag': 'ETag', '#compiled': 'Compiled'}
+
+    responses = batch_get({
+        DB_ALIAS_TABLE: {
+            'Keys': [{'Alias': {'S': setId}}],
+            'ConsistentRead': False
+        },
+        DB_DATA_TABLE: dataKeysAndAttributes
+    })
+
+    aliasItems = responses.get(DB_ALIAS_TABLE, [])
+    realSetId = alias_item_set_id(setId, aliasItems[0] if len(aliasItems) > 0 else None)
+    cache_alias(setId, realSetId, now)
+
+    if realSetId != setId:
+        return get_real_feature_set(realSetId, now)
+
+    dataItems = responses.get(DB_DATA_TABLE, [])
+    if len(dataItems) == 0:
+        forget_feature_set(setId)
+        return None
+
+    if entry is None:
+        return cache_feature_set(setId, dataItems[0], now)
+
+    if item_etag(dataItems[0]) == entry.etag:
+        entry.fetchedAt = now
+        return entry.value
+
+    return load_feature_set(setId, now)
+
+
+# get_feature_set for an id that's known not to be an alias
+def get_real_feature_set(setId, now):
+    entry = featureSetCache.get(setId)
+    if entry is not None:
+        if now - entry.fetchedAt < FEATURE_SET_CACHE_TTL:
+            return entry.value
+
+        # the TTL expired. if the ETag hasn't moved the decoded data is still
+        # good and we skip reading and decoding the Data attribute
+        etag = get_feature_set_etag(setId)
+        if etag is not None and etag == entry.etag:
+            entry.fetchedAt = now
+            return entry.value
+
+    return load_feature_set(setId, now)
+
+
+def load_feature_set(setId, now):
+    getDataRes = dynamodb.get_item(
+        TableName=DB_DATA_TABLE,
+        Key={
+            'FeatureSet': {
+                'S': setId
+            }
+        },
+        ProjectionExpression='#etag, #compiled',
+        ExpressionAttributeNames={
+            '#etag': 'ETag',
+            '#compiled': 'Compiled'
+        },
+        ConsistentRead=False,
+        ReturnConsumedCapacity='NONE'
+    )
+
+    if 'Item' not in getDataRes:
+        forget_feature_set(setId)
+        return None
 
-    for featureName in featureSetData['features']:
-        featureData = featureSetData['features'][featureName]
+    return cache_feature_set(setId, getDataRes['Item'], now)
 
-        if 'pctUsers' not in featureData:
-            continue
 
-        actualPercent = int(featureData['pctUsers'] * 100)
-        # shard   range is [0,100)
-        # percent range is [0,100]
-        #
-        # the user in shard 99 should see all features if actualPercent == 100
-        # and SHOULD NOT see the feature rolled out to 99% of users
-        if shard < actualPercent:
-            features.append(featureName)
+# same as get_feature_set for many ids. returns a dict of requested id to
+# CompiledFeatureSet. ids of sets that don't exist are left out. cached copies
+# are only served instead of reading when every set is cached
+def get_feature_set_batch(setIds):
+    stale = {}
+    for setId in setIds:
+        entry = cached_feature_set_entry(setId)
+        if entry is not None:
+            stale[setId] = entry
 
-    return {'features': features}
+    if len(stale) == len(setIds) and any(shed_read(entry, FEATURE_SET_CACHE_TTL) for entry in stale.values()):
+        return dict((setId, entry.value) for setId, entry in stale.iteritems())
 
+    try:
+        return read_feature_set_batch(setIds)
+    except Unavailable, e:
+        if len(stale) < len(setIds):
+            raise
+        served_stale(e)
+        return dict((setId, entry.value) for setId, entry in stale.iteritems())
 
-def get_feature_set_data(setId):
+
+def read_feature_set_batch(setIds):
+    now = time.time()
+
+    realSetIds = {}
+    unresolved = []
+    for setId in setIds:
+        entry = aliasCache.get(setId)
+        if entry is not None and now - entry.fetchedAt < ALIAS_CACHE_TTL:
+            realSetIds[setId] = entry.value
+        else:
+            unresolved.append(setId)
+
+    if len(unresolved) > 0:
+        aliasItems = batch_get_items(DB_ALIAS_TABLE, 'Alias', unresolved)
+        for setId in unresolved:
+            realSetId = alias_item_set_id(setId, aliasItems.get(setId))
+            cache_alias(setId, realSetId, now)
+            realSetIds[setId] = realSetId
+
+    featureSets = {}
+    expired = []
+    missing = []
+    for realSetId in set(realSetIds.values()):
+        entry = featureSetCache.get(realSetId)
+        if entry is None:
+            missing.append(realSetId)
+        elif now - entry.fetchedAt < FEATURE_SET_CACHE_TTL:
+            featureSets[realSetId] = entry.value
+        else:
+            expired.append(realSetId)
+
+    if len(expired) > 0:
+        etagItems = batch_get_items(DB_DATA_TABLE, 'FeatureSet', expired, ['ETag'])
+        for realSetId in expired:
+            entry = featureSetCache.get(realSetId)
+            if realSetId in etagItems and item_etag(etagItems[realSetId]) == entry.etag:
+                entry.fetchedAt = now
+                featureSets[realSetId] = entry.value
+            else:
+                missing.append(realSetId)
+
+    if len(missing) > 0:
+        dataItems = batch_get_items(DB_DATA_TABLE, 'FeatureSet', missing, EVALUATION_ATTRIBUTES)
+        for realSetId in missing:
+            if realSetId in dataItems:
+                featureSets[realSetId] = cache_feature_set(realSetId, dataItems[realSetId], now)
+            else:
+                forget_feature_set(realSetId)
+
+    res = {}
+    for setId in setIds:
+        if realSetIds[setId] in featureSets:
+            res[setId] = featureSets[realSetIds[setId]]
+    return res
+
+
+# the Data and ETag of a set or None if the set doesn't exist
+def get_feature_set_document(setId):
+    getDataRes = dynamodb.get_item(
+        TableName=DB_DATA_TABLE,
+        Key={
+            'FeatureSet': {
+                'S': setId
+            }
+        },
+        ProjectionExpression='#data, #etag',
+        ExpressionAttributeNames={
+            '#data': 'Data',
+            '#etag': 'ETag'
+        },
+        ConsistentRead=False,
+        ReturnConsumedCapacity='NONE'
+    )
+
+    return getDataRes.get('Item')
+
+
+def item_feature_set_data(item):
+    if 'Data' in item and 'B' in item['Data']:
+        data = item['Data']['B']
+        if data[:1] == DATA_ZLIB_MARKER:
+            data = zlib.decompress(data[1:])
+        return msgpack.loads(data)
+    return {}
+
+
+def cache_feature_set(setId, item, now):
+    etag = item_etag(item)
+
+    featureSet = None
+    if 'Compiled' in item and 'B' in item['Compiled']:
+        with requestLog.phase('decode'):
+            featureSet = CompactFeatureSet.parse(setId, etag, item['Compiled']['B'])
+        if featureSet is not None:
+            write_disk_cache('sets', setId, [etag, item['Compiled']['B']])
+
+    # sets last written before the Compiled attribute existed, or in a newer
+    # format than this version reads
+    if featureSet is None:
+        if 'Data' not in item:
+            item = get_feature_set_document(setId) or item
+            etag = item_etag(item)
+        with requestLog.phase('decode'):
+            featureSet = CompiledFeatureSet(setId, etag, item_feature_set_data(item))
+
+    featureSetCache.put(setId, CacheEntry(featureSet, etag, now))
+    return featureSet
+
+
+# BatchGetItem over a table keyed by a single string attribute. returns a dict
+# of key to item for the keys that exist
+def batch_get_items(tableName, keyName, keys, attributes=None):
+    items = {}
+
+    for i in xrange(0, len(keys), BATCH_GET_MAX_KEYS):
+        keysAndAttributes = {
+            'Keys': [{keyName: {'S': key}} for key in keys[i:i + BATCH_GET_MAX_KEYS]],
+            'ConsistentRead': False
+        }
+
+        if attributes is not None:
+            names = {}
+            for attribute in [keyName] + attributes:
+                names['#' + attribute.lower()] = attribute
+            keysAndAttributes['ProjectionExpression'] = ', '.join(sorted(names))
+            keysAndAttributes['ExpressionAttributeNames'] = names
+
+        responses = batch_get({tableName: keysAndAttributes})
+        for item in responses.get(tableName, []):
+            items[item[keyName]['S']] = item
+
+    return items
+
+
+# BatchGetItem that retries unprocessed keys. returns a dict of table name to
+# the list of items found
+def batch_get(requestItems):
+    responses = {}
+    retries = 0
+
+    while True:
+        batchRes = dynamodb.batch_get_item(
+            RequestItems=requestItems,
+            ReturnConsumedCapacity='NONE'
+        )
+
+        if 'Responses' in batchRes:
+            for tableName in batchRes['Responses']:
+                responses.setdefault(tableName, []).extend(batchRes['Responses'][tableName])
+
+        # keys DynamoDB didn't get to (e.g. throttling) come back here
+        if 'UnprocessedKeys' not in batchRes or len(batchRes['UnprocessedKeys']) == 0:
+            return responses
+
+        requestLog.count('throttle.unprocessed')
+        retries += 1
+        if not retry_after_backoff(retries):
+            raise Throttled('BatchGetItem left unprocessed keys')
+
+        requestItems = batchRes['UnprocessedKeys']
+
+
+def resolve_alias(setId):
+    now = time.time()
+    entry = aliasCache.get(setId)
+    if entry is not None and now - entry.fetchedAt < ALIAS_CACHE_TTL:
+        return entry.value
 
     getAliasRes = dynamodb.get_item(
         TableName=DB_ALIAS_TABLE,
@@ -187,36 +1202,675 @@ def get_feature_set_data(setId):
         ReturnConsumedCapacity='NONE'
     )
 
-    if 'Item' in getAliasRes:
-        if 'FeatureSet' in getAliasRes['Item']:
-            if 'S' in getAliasRes['Item']['FeatureSet']:
-                setId = getAliasRes['Item']['FeatureSet']['S']
+    realSetId = alias_item_set_id(setId, getAliasRes.get('Item'))
 
-    getDataRes = dynamodb.get_item(
+    cache_alias(setId, realSetId, now)
+    return realSetId
+
+
+# ids that aren't aliases are cached too so real set names don't pay for an
+# alias lookup on every request. only aliases are written to disk, and only
+# when they change
+def cache_alias(setId, realSetId, now):
+    previous = aliasCache.peek(setId)
+    aliasCache.put(setId, CacheEntry(realSetId, None, now))
+
+    if realSetId != setId:
+        if previous is None or previous.value != realSetId:
+            write_disk_cache('aliases', setId, realSetId)
+    elif previous is not None and previous.value != setId:
+        remove_disk_cache('aliases', setId)
+
+
+# the set an alias item points to, or setId itself when it isn't an alias
+def alias_item_set_id(setId, item):
+    if item is not None:
+        if 'FeatureSet' in item:
+            if 'S' in item['FeatureSet']:
+                return item['FeatureSet']['S']
+    return setId
+
+
+# returns the ETag of the set or None if the set doesn't exist
+def get_feature_set_etag(setId):
+    getEtagRes = dynamodb.get_item(
         TableName=DB_DATA_TABLE,
         Key={
             'FeatureSet': {
                 'S': setId
             }
         },
+        ProjectionExpression='#etag',
+        ExpressionAttributeNames={
+            '#etag': 'ETag'
+        },
         ConsistentRead=False,
         ReturnConsumedCapacity='NONE'
     )
 
-    if 'Item' in getDataRes:
-        item = getDataRes['Item']
-        if 'Data' in item and 'B' in item['Data']:
-            featureData = msgpack.loads(item['Data']['B'])
-            return featureData
-        else:
-            return {}
+    if 'Item' not in getEtagRes:
+        return None
+
+    return item_etag(getEtagRes['Item'])
+
+
+def item_etag(item):
+    if 'ETag' in item and 'N' in item['ETag']:
+        return item['ETag']['N']
+    return ''
+
+
+# the cached copy of setId (or the set it aliases) however old it is, or None.
+# copies on disk are loaded into memory the first time they're looked for
+def cached_feature_set_entry(setId):
+    aliasEntry = aliasCache.peek(setId)
+    if aliasEntry is None:
+        aliasEntry = load_disk_alias(setId)
+    if aliasEntry is not None:
+        setId = aliasEntry.value
+
+    entry = featureSetCache.peek(setId)
+    if entry is None:
+        entry = load_disk_feature_set(setId)
+    return entry
+
+
+# True when entry is past its ttl and should be served as it is because the
+# retry bucket is empty
+def shed_read(entry, ttl):
+    if entry is None or time.time() - entry.fetchedAt < ttl:
+        return False
+    if not retryBucket.empty():
+        return False
+    requestLog.count('stale.shed')
+    requestLog.fields['stale'] = True
+    return True
+
+
+# counts a cached copy being served because of e, an Unavailable
+def served_stale(e):
+    if isinstance(e, Throttled):
+        requestLog.count('stale.throttled')
     else:
+        requestLog.count('stale.unavailable')
+    requestLog.fields['stale'] = True
+
+
+# a set that no longer exists
+def forget_feature_set(setId):
+    featureSetCache.remove(setId)
+    remove_disk_cache('sets', setId)
+
+
+# the disk copy of setId, expired so it's checked before it's served
+def load_disk_feature_set(setId):
+    value = read_disk_cache('sets', setId)
+    if value is None:
+        return None
+
+    etag, compiled = value
+    with requestLog.phase('decode'):
+        featureSet = CompactFeatureSet.parse(setId, etag, compiled)
+    if featureSet is None:
+        return None
+
+    entry = CacheEntry(featureSet, etag, 0)
+    featureSetCache.put(setId, entry)
+    requestLog.count('disk.sets')
+    return entry
+
+
+def load_disk_alias(setId):
+    realSetId = read_disk_cache('aliases', setId)
+    if realSetId is None:
+        return None
+
+    entry = CacheEntry(realSetId, None, 0)
+    aliasCache.put(setId, entry)
+    requestLog.count('disk.aliases')
+    return entry
+
+
+# kind is 'sets' or 'aliases'. names are URL encoded, with a suffix so '.' and
+# '..' are plain files
+def disk_cache_path(kind, key):
+    return os.path.join(DISK_CACHE_DIR, kind, urllib.quote(key, safe='') + '.msgpack')
+
+
+# the disk cache is best effort. failing to read or write it is logged and
+# otherwise ignored
+def read_disk_cache(kind, key):
+    if DISK_CACHE_DIR == '':
         return None
 
+    try:
+        with requestLog.phase('disk'):
+            with open(disk_cache_path(kind, key), 'rb') as f:
+                return msgpack.loads(f.read())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            traceback.print_exc()
+    except Exception:
+        traceback.print_exc()
+    return None
+
+
+def write_disk_cache(kind, key, value):
+    if DISK_CACHE_DIR == '':
+        return
+
+    path = disk_cache_path(kind, key)
+    try:
+        with requestLog.phase('disk'):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise e
+
+            # write then rename so a restarted runtime never reads a partial copy
+            tmpPath = path + '.tmp'
+            with open(tmpPath, 'wb') as f:
+                f.write(msgpack.dumps(value))
+            os.rename(tmpPath, path)
+    except Exception:
+        traceback.print_exc()
+
+
+def remove_disk_cache(kind, key):
+    if DISK_CACHE_DIR == '':
+        return
+
+    try:
+        os.remove(disk_cache_path(kind, key))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            traceback.print_exc()
+
+
+# sleeps before retry number retry (from 1) of a throttled or failed call and
+# returns True, or returns False when it's out of retries
+def retry_after_backoff(retry):
+    if retry > THROTTLE_RETRIES:
+        requestLog.count('throttle.exhausted')
+        return False
+
+    if not retryBucket.take():
+        requestLog.count('throttle.shed')
+        return False
+
+    requestLog.count('throttle.retry')
+    with requestLog.phase('backoff'):
+        time.sleep(random.uniform(0, min(THROTTLE_BACKOFF_MAX, THROTTLE_BACKOFF_BASE * 2 ** (retry - 1))))
+    return True
+
+
+def error_code(e):
+    if 'Error' in e.response and 'Code' in e.response['Error']:
+        return e.response['Error']['Code']
+    return None
+
+
+# There are only 100 shards a user can land in so rather than walking every
+# feature on every request a set is compiled once per version into a table of
+# shard -> enabled feature names. Shard tables are built the first time a user
+# in that shard is seen.
+#
+# Response bodies are rendered once as well and handed back as-is on every
+# request. They're keyed by (setId, shard, etag): a new ETag means a new
+# CompiledFeatureSet so stale responses are dropped along with the old one.
+# Callers must not mutate them. Their JSON size is worked out once too, the
+# first time a response is logged.
+class CompiledFeatureSet(object):
+    def __init__(self, setId, etag, featureSetData):
+        self.setId = setId
+        self.etag = etag
+        # features on for 100% of users
+        self.allUsers = []
+        # (featureName, actualPercent) for every feature that has a pctUsers
+        self.thresholds = []
+        self.shards = [None] * 100
+        self.shardResponses = [None] * 100
+        self.shardResponseBytes = [None] * 100
+        self.allUsersResponse = {'features': self.allUsers, 'ETag': etag}
+        self.allUsersResponseBytes = None
+        pctUsers = {}
+        self.pctUsersResponse = {'pctUsers': pctUsers, 'ETag': etag}
+
+        if 'features' not in featureSetData:
+            return
+
+        for featureName in featureSetData['features']:
+            featureData = featureSetData['features'][featureName]
+
+            if 'pctUsers' not in featureData:
+                continue
+
+            pctUsers[featureName] = featureData['pctUsers']
+
+            if featureData['pctUsers'] == 1:
+                self.allUsers.append(featureName)
+
+            actualPercent = int(featureData['pctUsers'] * 100)
+            if actualPercent > 0:
+                self.thresholds.append((featureName, actualPercent))
+
+    def features_for_shard(self, shard):
+        features = self.shards[shard]
+        if features is None:
+            # shard   range is [0,100)
+            # percent range is [0,100]
+            #
+            # the user in shard 99 should see all features if actualPercent == 100
+            # and SHOULD NOT see the feature rolled out to 99% of users
+            features = [featureName for featureName, actualPercent in self.thresholds
+                        if shard < actualPercent]
+            self.shards[shard] = features
+        return features
+
+    def response_for_shard(self, shard):
+        response = self.shardResponses[shard]
+        if response is None:
+            with requestLog.phase('evaluate'):
+                response = {'features': self.features_for_shard(shard), 'ETag': self.etag}
+            self.shardResponses[shard] = response
+        return response
+
+    # size of the response for shard, or for all users when shard is None
+    def response_bytes(self, shard):
+        if shard is None:
+            if self.allUsersResponseBytes is None:
+                self.allUsersResponseBytes = len(logEncoder.encode(self.allUsersResponse))
+            return self.allUsersResponseBytes
+
+        size = self.shardResponseBytes[shard]
+        if size is None:
+            size = len(logEncoder.encode(self.response_for_shard(shard)))
+            self.shardResponseBytes[shard] = size
+        return size
+
+
+# a CompiledFeatureSet read from the Compiled attribute instead of Data. nothing
+# is decoded up front. features are ordered so the features of a shard are a
+# prefix of the names (see compile_feature_set in the private Lambda), found by
+# a binary search of the threshold bytes. a name is decoded the first time a
+# response includes it
+class CompactFeatureSet(CompiledFeatureSet):
+    def __init__(self, setId, etag, view, count):
+        self.setId = setId
+        self.etag = etag
+        self.view = view
+        self.count = count
+        self.thresholds = bytearray(view[8:8 + count])
+        self.offsets = None
+        self.names = []
+        self.shards = [None] * 100
+        self.shardResponses = [None] * 100
+        self.shardResponseBytes = [None] * 100
+        self.allUsersResponseBytes = None
+
+        allUsersCount = 0
+        while allUsersCount < count and self.thresholds[allUsersCount] & COMPILED_ALL_USERS:
+            allUsersCount += 1
+        self.allUsers = self.feature_names(allUsersCount)
+        self.allUsersResponse = {'features': self.allUsers, 'ETag': etag}
+
+        # read from Data on the first GET /set/{set_id}/pct_users
+        self.pctUsers = None
+
+    # returns None when compiled isn't a format this version understands
+    @classmethod
+    def parse(cls, setId, etag, compiled):
+        view = memoryview(compiled)
+        if len(view) < 8:
+            return None
+
+        magic, version, count = struct.unpack_from('>3sBI', view, 0)
+        if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+            return None
+
+        return cls(setId, etag, view, count)
+
+    # the first n feature names
+    def feature_names(self, n):
+        if n > len(self.names):
+            if self.offsets is None:
+                self.offsets = struct.unpack_from('>{}I'.format(self.count + 1), self.view, 8 + self.count)
+                self.namesStart = 8 + self.count + 4 * (self.count + 1)
+
+            view = self.view
+            namesStart = self.namesStart
+            offsets = self.offsets
+            for i in xrange(len(self.names), n):
+                self.names.append(view[namesStart + offsets[i]:namesStart + offsets[i + 1]].tobytes())
+
+        return self.names[:n]
+
+    def features_for_shard(self, shard):
+        features = self.shards[shard]
+        if features is None:
+            # same rule as CompiledFeatureSet.features_for_shard: a feature is
+            # on when shard < percent. percents are in descending order
+            thresholds = self.thresholds
+            lo, hi = 0, self.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if shard < thresholds[mid] & COMPILED_PERCENT_MASK:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            features = self.feature_names(lo)
+            self.shards[shard] = features
+        return features
+
+    @property
+    def pctUsersResponse(self):
+        if self.pctUsers is not None:
+            return self.pctUsers
+
+        item = get_feature_set_document(self.setId) or {}
+        response = CompiledFeatureSet(self.setId, item_etag(item), item_feature_set_data(item)).pctUsersResponse
+
+        # only kept if the set hasn't changed since it was compiled
+        if response['ETag'] == self.etag:
+            self.pctUsers = response
+        return response
+
+
+class CacheEntry(object):
+    __slots__ = ('value', 'etag', 'fetchedAt')
+
+    def __init__(self, value, etag, fetchedAt):
+        self.value = value
+        self.etag = etag
+        self.fetchedAt = fetchedAt
+
+
+# a bounded map that evicts the least recently used entry when full
+class LRUCache(object):
+    def __init__(self, name, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hitCounter = 'cache.' + name + '.hit'
+        self.missCounter = 'cache.' + name + '.miss'
+
+    # the entry for key without counting a hit or miss or marking it used
+    def peek(self, key):
+        return self.entries.get(key)
+
+    # a hit only means the key is cached. callers still check its age
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+            requestLog.count(self.hitCounter)
+        else:
+            requestLog.count(self.missCounter)
+        return entry
+
+    def put(self, key, entry):
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+
+featureSetCache = LRUCache('featureSet', FEATURE_SET_CACHE_SIZE)
+aliasCache = LRUCache('alias', ALIAS_CACHE_SIZE)
+setsCache = None
+aliasesCache = None
+
+
+# collects what's logged about the current request
+class RequestLog(object):
+    def __init__(self, req, context):
+        self.start = time.time()
+        self.fields = {
+            'method': req.get('http_method'),
+            'path': req.get('resource_path')
+        }
+        if req.get('set_id'):
+            self.fields['setId'] = req['set_id']
+        if context is not None:
+            self.fields['requestId'] = getattr(context, 'aws_request_id', None)
+        # phase -> seconds
+        self.phases = {}
+        # counter -> count
+        self.counts = {}
+        self.consumedCapacity = 0.0
+        # table -> {'read': units, 'write': units}
+        self.tableCapacity = {}
+
+    def phase(self, name):
+        return PhaseTimer(self, name)
+
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    # sizes are summed when a request serves several
+    def add_bytes(self, name, n):
+        self.fields[name] = self.fields.get(name, 0) + n
+
+    # ConsumedCapacity from a DynamoDB response. it's a list for batch calls.
+    # kind is 'read' or 'write'
+    def consumed(self, kind, consumedCapacity):
+        if isinstance(consumedCapacity, dict):
+            consumedCapacity = [consumedCapacity]
+        for capacity in consumedCapacity:
+            units = capacity.get('CapacityUnits', 0)
+            self.consumedCapacity += units
+            tableCapacity = self.tableCapacity.get(capacity.get('TableName'))
+            if tableCapacity is None:
+                tableCapacity = {'read': 0.0, 'write': 0.0}
+                self.tableCapacity[capacity.get('TableName')] = tableCapacity
+            tableCapacity[kind] += units
+
+    def emit(self, status):
+        if not REQUEST_LOG:
+            return
+
+        # emitted once per request, so the fields are reused for the line
+        line = self.fields
+        line['log'] = 'request'
+        line['status'] = int(status)
+        line['ms'] = round((time.time() - self.start) * 1000, 3)
+        phasesMs = {}
+        for name, seconds in self.phases.iteritems():
+            phasesMs[name] = round(seconds * 1000, 3)
+        line['phasesMs'] = phasesMs
+        line['counts'] = self.counts
+        line['consumedCapacity'] = self.consumedCapacity
+        print(logEncoder.encode(line))
+
+
+class PhaseTimer(object):
+    __slots__ = ('requestLog', 'name', 'start')
+
+    def __init__(self, requestLog, name):
+        self.requestLog = requestLog
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        self.requestLog.add_time(self.name, time.time() - self.start)
+
+
+# times every call to the wrapped boto3 client as the phase dynamodb.<operation>
+# and retries throttled and failed calls. see THROTTLE_RETRIES
+class TimedClient(object):
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        phase = 'dynamodb.' + name
+        kind = 'read'
+        if name in WRITE_OPERATIONS:
+            kind = 'write'
+
+        def timed_call(kwargs):
+            start = time.time()
+            try:
+                return attr(**kwargs)
+            finally:
+                requestLog.add_time(phase, time.time() - start)
+                requestLog.count(phase)
+
+        def call(**kwargs):
+            if CAPACITY_ACCOUNTING and kwargs.get('ReturnConsumedCapacity', 'NONE') == 'NONE':
+                kwargs['ReturnConsumedCapacity'] = 'TOTAL'
+
+            retry = 0
+            while True:
+                try:
+                    res = timed_call(kwargs)
+                    break
+                except botocore.exceptions.ClientError as e:
+                    code = error_code(e)
+                    if code in THROTTLING_ERRORS:
+                        requestLog.count('throttle.throttled')
+                    elif code in SERVER_ERRORS:
+                        requestLog.count('dynamodb.error')
+                    else:
+                        raise
+
+                    retry += 1
+                    if not retry_after_backoff(retry):
+                        if code in THROTTLING_ERRORS:
+                            raise Throttled(code)
+                        raise Unavailable(code)
+                except (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError) as e:
+                    # connection resets and read timeouts the SDK would have
+                    # retried
+                    requestLog.count('dynamodb.error')
+                    retry += 1
+                    if not retry_after_backoff(retry):
+                        raise Unavailable(str(e))
+
+            if 'ConsumedCapacity' in res:
+                requestLog.consumed(kind, res['ConsumedCapacity'])
+            return res
+
+        # later lookups find it without going through __getattr__
+        setattr(self, name, call)
+        return call
+
+
+# consumed capacity summed per route ("GET /set/{set_id}/features"), feature
+# set and table since the last flush
+class CapacityAccount(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.invocations = 0
+        self.routes = {}
+        self.sets = {}
+        self.tables = {}
+
+    def record(self, requestLog):
+        self.invocations += 1
+
+        read = 0.0
+        write = 0.0
+        for tableName, tableCapacity in requestLog.tableCapacity.iteritems():
+            read += tableCapacity['read']
+            write += tableCapacity['write']
+            add_capacity(self.tables, tableName, tableCapacity['read'], tableCapacity['write'])
+
+        route = '{} {}'.format(requestLog.fields.get('method'), requestLog.fields.get('path'))
+        add_capacity(self.routes, route, read, write)
+        if 'setId' in requestLog.fields:
+            add_capacity(self.sets, requestLog.fields['setId'], read, write)
+
+        if self.invocations >= CAPACITY_FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        line = {
+            'log': 'capacity',
+            'invocations': self.invocations,
+            'seconds': round(time.time() - self.start, 3),
+            'routes': self.routes,
+            'sets': self.sets,
+            'tables': self.tables
+        }
+        print(json.dumps(line, sort_keys=True, separators=(',', ':')))
+        self.reset()
+
+
+def add_capacity(totals, key, read, write):
+    total = totals.get(key)
+    if total is None:
+        total = {'requests': 0, 'read': 0.0, 'write': 0.0}
+        totals[key] = total
+    total['requests'] += 1
+    total['read'] += read
+    total['write'] += write
+
+
+class TokenBucket(object):
+    def __init__(self, size, rate):
+        self.size = size
+        self.rate = rate
+        self.tokens = size
+        self.refilledAt = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.size, self.tokens + (now - self.refilledAt) * self.rate)
+        self.refilledAt = now
+
+    # takes a token and returns True, or returns False when there are none
+    def take(self):
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def empty(self):
+        self.refill()
+        return self.tokens < 1
+
+
+# requests handled outside of lambda_handler log nothing
+requestLog = RequestLog({}, None)
+capacityAccount = CapacityAccount()
+retryBucket = TokenBucket(RETRY_BUCKET_SIZE, RETRY_BUCKET_RATE)
+dynamodb = TimedClient(dynamodb)
+
 
 class HTTPError(Exception):
     def __init__(self, status_code):
         super(HTTPError, self).__init__(status_code)
+        self.status_code = status_code
+
+
+# a DynamoDB call that couldn't reach DynamoDB or still failed after retrying
+class Unavailable(Exception):
+    pass
+
+
+# an Unavailable call that was throttled
+class Throttled(Unavailable):
+    pass
+
+
+def s304():
+    raise HTTPError("304")
 
 
 def s400():
@@ -229,3 +1883,7 @@ def s404():
 
 def s500():
     raise HTTPError("500")
+
+
+def s503():
+    raise HTTPError("503")
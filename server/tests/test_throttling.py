@@ -0,0 +1,162 @@
+# (c) 2016-2017 Adobe.  All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+# The public Lambda against a throttled DynamoDB stand-in: what it serves from
+# its cache, what gets a 503 and when it stops retrying.
+#
+#   python -m unittest discover -s tests
+#
+# run from server/ with the Lambdas' dependencies (boto3, msgpack) installed
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(TESTS_DIR)
+
+sys.path.insert(0, os.path.join(SERVER_DIR, 'bench'))
+from fake_dynamodb import FakeDynamoDB
+
+public = imp.load_source('public_lambda_function', os.path.join(SERVER_DIR, 'public', 'lambda_function.py'))
+private = imp.load_source('private_lambda_function', os.path.join(SERVER_DIR, 'private', 'lambda_function.py'))
+
+SET_ID = 'PROD-BlogService-default'
+
+
+class Context(object):
+    aws_request_id = 'test'
+
+
+# the status lambda_handler answers with. the Lambdas log a line per request
+# and print tracebacks for errors, which are dropped
+def call(function, req):
+    stdout = sys.stdout
+    stderr = sys.stderr
+    sys.stdout = sys.stderr = StringIO()
+    try:
+        return '200', function.lambda_handler(req, Context())
+    except function.HTTPError as e:
+        return e.status_code, None
+    finally:
+        sys.stdout = stdout
+        sys.stderr = stderr
+
+
+def get_features(setId, **params):
+    return dict({'http_method': 'GET', 'resource_path': '/set/{set_id}/features', 'set_id': setId}, **params)
+
+
+class ThrottlingTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeDynamoDB()
+        public.dynamodb = public.TimedClient(self.fake)
+        private.dynamodb = private.TimedClient(self.fake)
+
+        self.saved = dict((name, getattr(public, name)) for name in
+                          ['DISK_CACHE_DIR', 'FEATURE_SET_CACHE_TTL', 'THROTTLE_BACKOFF_BASE'])
+        public.DISK_CACHE_DIR = tempfile.mkdtemp()
+        public.THROTTLE_BACKOFF_BASE = 0
+        public.featureSetCache = public.LRUCache('featureSet', public.FEATURE_SET_CACHE_SIZE)
+        public.aliasCache = public.LRUCache('alias', public.ALIAS_CACHE_SIZE)
+        public.setsCache = None
+        public.aliasesCache = None
+        public.retryBucket = public.TokenBucket(public.RETRY_BUCKET_SIZE, 0)
+
+        call(private, {'http_method': 'POST', 'resource_path': '/set', 'body': {'channelSet': SET_ID}})
+        status, _ = call(private, {
+            'http_method': 'PUT',
+            'resource_path': '/set/{set_id}',
+            'set_id': SET_ID,
+            'headers': {'if-match': '1'},
+            'body': {'features': {'comments': {'pctUsers': 1}}}
+        })
+        self.assertEqual(status, '200')
+
+    def tearDown(self):
+        shutil.rmtree(public.DISK_CACHE_DIR, ignore_errors=True)
+        for name, value in self.saved.items():
+            setattr(public, name, value)
+
+    # cached in memory and on disk, then past its TTL once DynamoDB throttles
+    def cache_and_throttle(self):
+        status, res = call(public, get_features(SET_ID, user_id='user-1'))
+        self.assertEqual(status, '200')
+        self.assertNotIn('stale', res)
+
+        public.FEATURE_SET_CACHE_TTL = 0
+        self.fake.throttle = 1
+
+    def test_cached_set_served_stale(self):
+        self.cache_and_throttle()
+
+        status, res = call(public, get_features(SET_ID, user_id='user-1'))
+        self.assertEqual(status, '200')
+        self.assertEqual(res['features'], ['comments'])
+        self.assertTrue(res['stale'])
+        self.assertTrue(public.requestLog.fields['stale'])
+
+    def test_cached_set_served_stale_from_disk(self):
+        self.cache_and_throttle()
+        public.featureSetCache = public.LRUCache('featureSet', public.FEATURE_SET_CACHE_SIZE)
+
+        status, res = call(public, get_features(SET_ID, user_id='user-1'))
+        self.assertEqual(status, '200')
+        self.assertTrue(res['stale'])
+
+    def test_uncached_set_unavailable(self):
+        self.fake.throttle = 1
+
+        status, _ = call(public, get_features(SET_ID, user_id='user-1'))
+        self.assertEqual(status, '503')
+
+    def test_aliases_unavailable(self):
+        self.fake.throttle = 1
+
+        status, _ = call(public, {'http_method': 'GET', 'resource_path': '/aliases'})
+        self.assertEqual(status, '503')
+
+    def test_changes_unavailable(self):
+        self.fake.throttle = 1
+
+        status, _ = call(public, {'http_method': 'GET', 'resource_path': '/changes', 'since': '0'})
+        self.assertEqual(status, '503')
+
+    def test_not_modified_from_cache(self):
+        self.cache_and_throttle()
+        etag = self.fake.tables[public.DB_DATA_TABLE][SET_ID]['ETag']['N']
+
+        status, _ = call(public, get_features(SET_ID, headers={'if-none-match': etag}))
+        self.assertEqual(status, '304')
+
+    def test_retries_until_bucket_empty(self):
+        self.fake.throttle = 1
+
+        call(public, get_features(SET_ID, user_id='user-1'))
+        self.assertEqual(public.requestLog.counts.get('throttle.retry'), public.THROTTLE_RETRIES)
+
+        public.retryBucket = public.TokenBucket(public.RETRY_BUCKET_SIZE, 0)
+        public.retryBucket.tokens = 0
+        self.fake.reset_calls()
+
+        status, _ = call(public, get_features(SET_ID, user_id='user-1'))
+        self.assertEqual(status, '503')
+        self.assertNotIn('throttle.retry', public.requestLog.counts)
+        self.assertEqual(public.requestLog.counts['throttle.shed'], self.fake.total_calls())
+        self.assertEqual(public.requestLog.counts['throttle.throttled'], self.fake.total_calls())
+
+
+if __name__ == '__main__':
+    unittest.main()